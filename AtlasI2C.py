@@ -1,98 +1,255 @@
 #!/usr/bin/python
 
-import io         # used to create file streams
-from io import open
-import fcntl      # used to access I2C parameters like addresses
-
 import time       # used for sleep delay and timestamps
-import string     # helps parse strings
+import asyncio    # used for the asyncio variant of query
+
+from collections import namedtuple
+from concurrent.futures import Future
+from enum import IntEnum
+
+from i2c_bus import I2CBus  # owns the bus file descriptor and serializes access to it
+import hardware            # the clock, so a replayed trace doesn't wait in real time
+import metrics             # query latency histogram
+
+QUERY_SECONDS = metrics.histogram('tank_atlas_query_seconds', 'Time taken by AtlasI2C.query', ('command',))
+
+# maps every byte to itself with the MSB cleared
+# NOTE: having to change the MSB to 0 is a glitch in the raspberry pi, and you shouldn't have to do this!
+CLEAR_MSB = bytes(i & 0x7f for i in range(256))
+
+
+class Status(IntEnum):
+	# the first byte of every response
+	SUCCESS = 1
+	SYNTAX_ERROR = 2
+	PENDING = 254           # still processing, read again later
+	NO_DATA = 255           # nothing to send
+
+
+class Response(namedtuple('Response', ['status', 'text'])):
+	# a decoded response: the status and the payload up to the terminating null
+
+	__slots__ = ()
+
+	def ok(self):
+		return self.status == Status.SUCCESS
+
+	@property
+	def fields(self):
+		# comma separated payloads, like "?I,pH,2.0"
+		return self.text.split(',')
+
+	@property
+	def value(self):
+		# the payload as a number, None if it isn't one
+		try:
+			return float(self.text)
+		except ValueError:
+			return None
+
+	def __str__(self):
+		if self.ok():
+			return "Command succeeded " + self.text
+		return "Error " + str(int(self.status))
+
+
+def decode(buffer, count):
+	# decode count bytes of a response without touching the bytes one at a time
+	try:
+		status = Status(buffer[0])
+	except ValueError:
+		status = buffer[0]
+	payload = bytes(buffer[1:count]).translate(CLEAR_MSB)
+	end = payload.find(b'\0')
+	if end >= 0:
+		payload = payload[:end]
+	return Response(status, payload.decode('latin-1'))
 
 
 class AtlasI2C:
 	long_timeout = 1.5         	# the timeout needed to query readings and calibrations
 	short_timeout = .5         	# timeout for regular commands
+	long_delay = .9            	# how long readings and calibrations usually take
+	short_delay = .3           	# how long regular commands usually take
+	poll_interval = .05        	# how often to ask a board that is still processing again
+	max_response = 31          	# the largest response we read
 	default_bus = 1         	# the default bus for I2C on the newer Raspberry Pis, certain older boards use bus 0
 	default_address = 98     	# the default address for the sensor
 	current_addr = default_address
 
 	def __init__(self, address=default_address, bus=default_bus):
-		# open two file streams, one for reading and one for writing
+		# all boards on a bus share one bus manager, which owns the file descriptor
 		# the specific I2C channel is selected with bus
 		# it is usually 1, except for older revisions where its 0
-		# wb and rb indicate binary read and write
-		self.file_read = io.open("/dev/i2c-"+str(bus), "rb", buffering=0)
-		self.file_write = io.open("/dev/i2c-"+str(bus), "wb", buffering=0)
+		self.bus = I2CBus.get(bus)
+
+		# responses are read into this buffer, only ever touched by the bus thread
+		self.__buffer = bytearray(self.max_response)
 
 		# initializes I2C to either a user specified or default address
 		self.set_i2c_address(address)
 
 	def set_i2c_address(self, addr):
-		# set the I2C communications to the slave specified by the address
-		# The commands for I2C dev using the ioctl functions are specified in
-		# the i2c-dev.h file from i2c-tools
-		I2C_SLAVE = 0x703
-		fcntl.ioctl(self.file_read, I2C_SLAVE, addr)
-		fcntl.ioctl(self.file_write, I2C_SLAVE, addr)
+		# set the I2C slave this object talks to
+		# the bus manager only issues the ioctl when a transaction for a different address runs
 		self.current_addr = addr
 
 	def write(self, cmd):
 		# appends the null character and sends the string over I2C
-		cmd += "\00"
-		self.file_write.write(cmd.encode('latin-1'))
+		self.submit_write(cmd).result()
 
 	def read(self, num_of_bytes=31):
-		# reads a specified number of bytes from I2C, then parses and displays the result
-		res = self.file_read.read(num_of_bytes)         # read from the board
-		if type(res[0]) is str:					# if python2 read
-			response = [i for i in res if i != '\x00']
-			if ord(response[0]) == 1:             # if the response isn't an error
-				# change MSB to 0 for all received characters except the first and get a list of characters
-				# NOTE: having to change the MSB to 0 is a glitch in the raspberry pi, and you shouldn't have to do this!
-				char_list = list(map(lambda x: chr(ord(x) & ~0x80), list(response[1:])))
-				return "Command succeeded " + ''.join(char_list)     # convert the char list to a string and returns it
-			else:
-				return "Error " + str(ord(response[0]))
-				
-		else:									# if python3 read
-			if res[0] == 1: 
-				# change MSB to 0 for all received characters except the first and get a list of characters
-				# NOTE: having to change the MSB to 0 is a glitch in the raspberry pi, and you shouldn't have to do this!
-				char_list = list(map(lambda x: chr(x & ~0x80), list(res[1:])))
-				return "Command succeeded " + ''.join(char_list)     # convert the char list to a string and returns it
-			else:
-				return "Error " + str(res[0])
+		# reads a response from the board into our buffer and decodes it on the bus thread
+		return self.submit_read(num_of_bytes).result()
 
-	def query(self, string):
-		# write a command to the board, wait the correct timeout, and read the response
-		self.write(string)
+	def submit_write(self, cmd):
+		# queue the write on the bus thread, returns a Future
+		data = (cmd + "\00").encode('latin-1')
+		return self.bus.submit(self.current_addr, lambda device: device.write(data))
+
+	def submit_read(self, num_of_bytes=31):
+		# queue the read on the bus thread, returns a Future for the decoded response
+		def read_response(device):
+			view = memoryview(self.__buffer)[:num_of_bytes]
+			count = device.readinto(view)
+			return decode(view, count)
+		return self.bus.submit(self.current_addr, read_response)
 
-		# the read and calibration commands require a longer timeout
+	def processing_delay(self, string):
+		# how long the board usually needs to process a command before the response can be read,
+		# and how long to keep asking if it is still processing
+		# None means the board won't respond at all
 		if((string.upper().startswith("R")) or
 			(string.upper().startswith("CAL"))):
-			time.sleep(self.long_timeout)
+			# the read and calibration commands take longer
+			return self.long_delay, self.long_timeout
 		elif string.upper().startswith("SLEEP"):
-			return "sleep mode"
+			return None
 		else:
-			time.sleep(self.short_timeout)
+			return self.short_delay, self.short_timeout
 
-		return self.read()
+	def read_when_ready(self, deadline):
+		# read the response, asking again while the board reports it is still processing
+		response = self.read()
+		while response.status == Status.PENDING and hardware.clock.time() < deadline:
+			hardware.clock.sleep(self.poll_interval)
+			response = self.read()
+		return response
+
+	def query(self, string):
+		# write a command to the board, wait for it to process, and read the response
+		# the board is ours from the write until the read, nobody else can slip a command in between
+		# only the command name is used as a label, "RT,25.1" is recorded as "RT"
+		with QUERY_SECONDS.time(command=string.split(',')[0].upper()), self.bus.lock(self.current_addr):
+			self.write(string)
+			started = hardware.clock.time()
+
+			delay = self.processing_delay(string)
+			if delay is None:
+				return Response(Status.NO_DATA, "sleep mode")
+			hardware.clock.sleep(delay[0])
+
+			return self.read_when_ready(started + delay[1])
+
+	def issue(self, string):
+		# write a command to the board and return a Future for the response
+		# the response is collected in the background once the board has finished processing,
+		# so the caller is free to issue commands to other boards in the meantime
+		# the board's lock is held until the response has been collected
+		lock = self.bus.lock(self.current_addr)
+		lock.acquire()
+		try:
+			self.write(string)
+		except Exception:
+			lock.release()
+			raise
+		started = hardware.clock.time()
+
+		future = Future()
+		delay = self.processing_delay(string)
+		if delay is None:
+			lock.release()
+			future.set_result(Response(Status.NO_DATA, "sleep mode"))
+			return future
+
+		timer = hardware.clock.timer(delay[0], self.collect, (future, started + delay[1], lock))
+		timer.start()
+		return future
+
+	def collect(self, future, deadline, lock=None):
+		# read the response for an issued command into its Future, then let go of the board
+		try:
+			if not future.set_running_or_notify_cancel():
+				return
+			try:
+				future.set_result(self.read_when_ready(deadline))
+			except Exception as e:
+				future.set_exception(e)
+		finally:
+			if lock is not None:
+				lock.release()
+
+	def stream(self, temperature=None, threshold=0.1):
+		# yield (timestamp, response) for a reading about every long_delay seconds, the fastest the board can go
+		# in I2C mode the EZO boards have no continuous mode, so the next R is issued as soon as the last one is read
+		# temperature() returns the temperature to compensate with, or None if there isn't one yet;
+		# it is only sent with T when it has moved by more than threshold since it was last sent
+		compensated = None
+		while True:
+			if temperature is not None:
+				tempC = temperature()
+				if tempC is not None and (compensated is None or abs(tempC - compensated) > threshold):
+					if self.query("T," + str(tempC)).ok():
+						compensated = tempC
+
+			response = self.query("R")
+			yield hardware.clock.time(), response
+
+	async def query_async(self, string):
+		# asyncio variant of query, waits for the board without blocking the event loop
+		lock = self.bus.lock(self.current_addr)
+		while not lock.acquire(blocking=False):
+			await asyncio.sleep(self.poll_interval)
+		try:
+			return await self.__query_async(string)
+		finally:
+			lock.release()
+
+	async def __query_async(self, string):
+		# the bus transactions are awaited too, so the loop never blocks on the bus thread
+		await asyncio.wrap_future(self.submit_write(string))
+		started = hardware.clock.time()
+
+		delay = self.processing_delay(string)
+		if delay is None:
+			return Response(Status.NO_DATA, "sleep mode")
+		await asyncio.sleep(delay[0])
+
+		response = await asyncio.wrap_future(self.submit_read())
+		while response.status == Status.PENDING and hardware.clock.time() < started + delay[1]:
+			await asyncio.sleep(self.poll_interval)
+			response = await asyncio.wrap_future(self.submit_read())
+		return response
 
 	def close(self):
-		self.file_read.close()
-		self.file_write.close()
+		# the bus manager is shared with the other boards on the bus, so there is nothing to close
+		pass
 
 	def list_i2c_devices(self):
-		prev_addr = self.current_addr # save the current address so we can restore it after
-		i2c_devices = []
-		for i in range (0,128):
-			try:
-				self.set_i2c_address(i)
-				self.read(1)
-				i2c_devices.append(i)
-			except IOError:
-				pass
-		self.set_i2c_address(prev_addr) # restore the address we were using
-		return i2c_devices
+		# 0x00-0x07 and 0x78-0x7f are reserved, nothing will answer there
+		return [i for i in range(0x08, 0x78) if self.bus.probe(i)]
+
+
+def query_all(devices, string):
+	# send a command to several boards at once so they all process it in parallel,
+	# one round takes about one processing delay instead of the sum of them
+	futures = [device.issue(string) for device in devices]
+	return [future.result() for future in futures]
+
+
+async def query_all_async(devices, string):
+	# asyncio variant of query_all
+	return await asyncio.gather(*[device.query_async(string) for device in devices])
 
 		
 def main():
@@ -125,7 +282,7 @@ def main():
 
 		# continuous polling command automatically polls the board
 		elif user_cmd.upper().startswith("POLL"):
-			delaytime = float(string.split(user_cmd, ',')[1])
+			delaytime = float(user_cmd.split(',')[1])
 
 			# check for polling time being too short, change it to the minimum timeout if too short
 			if delaytime < AtlasI2C.long_timeout:
@@ -133,7 +290,7 @@ def main():
 				delaytime = AtlasI2C.long_timeout
 
 			# get the information of the board you're polling
-			info = string.split(device.query("I"), ",")[1]
+			info = device.query("I").fields[1]
 			print("Polling %s sensor every %0.2f seconds, press ctrl-c to stop polling" % (info, delaytime))
 
 			try:
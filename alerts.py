@@ -0,0 +1,212 @@
+import collections
+import json
+import logging
+import smtplib
+import subprocess
+import threading
+import urllib.request
+
+from collections import namedtuple
+from email.message import EmailMessage
+
+import hardware
+import metrics
+
+ALERTS = metrics.counter('tank_alerts_total', 'Alerts by what happened to them', ('result',))
+
+
+class Alert(namedtuple('Alert', ['key', 'subject', 'body', 'timestamp'])):
+    __slots__ = ()
+
+class SendmailTransport:
+    '''
+    Hands alerts to the local MTA
+    '''
+    def __init__(self, sender, recipient, path='/usr/sbin/sendmail', timeout=30):
+        self.sender = sender
+        self.recipient = recipient
+        self.path = path
+        self.timeout = timeout
+
+    def send(self, subject, body):
+        message = EmailMessage()
+        message['From'] = self.sender
+        message['To'] = self.recipient
+        message['Subject'] = subject
+        message.set_content(body)
+        result = subprocess.run([self.path, '-t', '-i'], input=message.as_bytes(),
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=self.timeout)
+        if result.returncode != 0:
+            raise IOError('sendmail exited with status %d: %s' % (result.returncode, result.stderr.decode(errors='replace').strip()))
+
+class SMTPTransport:
+    def __init__(self, sender, recipient, host='localhost', port=25, timeout=30):
+        self.sender = sender
+        self.recipient = recipient
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def send(self, subject, body):
+        message = EmailMessage()
+        message['From'] = self.sender
+        message['To'] = self.recipient
+        message['Subject'] = subject
+        message.set_content(body)
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            smtp.send_message(message)
+
+class WebhookTransport:
+    '''
+    POSTs alerts as JSON, {"subject": ..., "body": ...}
+    '''
+    def __init__(self, url, timeout=15):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, subject, body):
+        data = json.dumps({ 'subject': subject, 'body': body }).encode()
+        request = urllib.request.Request(self.url, data=data, headers={ 'Content-Type': 'application/json' })
+        # urlopen raises for error statuses
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+class AlertDispatcher:
+    '''
+    Sends alerts from a background thread so control jobs never wait on them.
+
+    An alert with the same key as one sent less than dedup_interval seconds
+    ago is suppressed, and the next one that does go out says how many were.
+    The sender waits digest_delay seconds after the first alert of a burst,
+    then sends everything that arrived as a single digest. At most
+    max_pending alerts are held, the oldest are dropped when there are more.
+    Every alert goes to every transport.
+    '''
+    def __init__(self, transports, max_pending=100, dedup_interval=3600, digest_delay=30, logger=None):
+        self.transports = list(transports)
+        self.dedup_interval = dedup_interval
+        self.digest_delay = digest_delay
+        self.sent = 0
+        self.suppressed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.__pending = collections.deque(maxlen=max_pending)
+        self.__last_sent = {}
+        self.__suppressed = collections.Counter()
+        self.__condition = threading.Condition()
+        self.__logger = logger or logging.getLogger(__name__)
+        self.__thread = None
+        self.__closed = False
+
+    def submit(self, key, subject, body):
+        '''
+        Queue an alert, returns False if it was suppressed as a duplicate
+        '''
+        now = hardware.clock.time()
+        with self.__condition:
+            last_sent = self.__last_sent.get(key)
+            if last_sent is not None and now - last_sent < self.dedup_interval:
+                self.__suppressed[key] += 1
+                self.suppressed += 1
+                ALERTS.inc(result='suppressed')
+                return False
+            if any(alert.key == key for alert in self.__pending):
+                self.__suppressed[key] += 1
+                self.suppressed += 1
+                ALERTS.inc(result='suppressed')
+                return False
+
+            if len(self.__pending) == self.__pending.maxlen:
+                self.dropped += 1
+                ALERTS.inc(result='dropped')
+            self.__pending.append(Alert(key, subject, body, now))
+            self.__last_sent[key] = now
+            self.__condition.notify()
+
+        if self.__thread is None:
+            self.start()
+        return True
+
+    def depth(self):
+        with self.__condition:
+            return len(self.__pending)
+
+    def stats(self):
+        with self.__condition:
+            return {
+                'queue_depth': len(self.__pending),
+                'sent': self.sent,
+                'suppressed': self.suppressed,
+                'dropped': self.dropped,
+                'errors': self.errors,
+            }
+
+    def start(self):
+        with self.__condition:
+            if self.__thread is None and not self.__closed:
+                self.__thread = threading.Thread(target=self.__run, name='alerts', daemon=True)
+                self.__thread.start()
+
+    def close(self, timeout=5):
+        '''
+        Send whatever is pending without waiting for the digest, giving up after timeout seconds
+        '''
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify()
+            thread = self.__thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while not self.__pending and not self.__closed:
+                    self.__condition.wait()
+                # Let the rest of a burst arrive so it goes out as one digest. Every
+                # submit wakes us, so keep waiting until the first one's delay is up
+                deadline = self.__pending[0].timestamp + self.digest_delay if self.__pending else None
+                while not self.__closed and deadline is not None:
+                    remaining = deadline - hardware.clock.time()
+                    if remaining <= 0:
+                        break
+                    self.__condition.wait(remaining)
+                alerts = list(self.__pending)
+                self.__pending.clear()
+                suppressed = {alert.key: self.__suppressed.pop(alert.key, 0) for alert in alerts}
+                closed = self.__closed
+
+            if alerts:
+                self.__send(alerts, suppressed)
+            if closed:
+                return
+
+    def __send(self, alerts, suppressed):
+        if len(alerts) == 1:
+            subject = alerts[0].subject
+        else:
+            subject = '%d tank monitor alerts' % len(alerts)
+
+        parts = []
+        for alert in alerts:
+            text = alert.body
+            if len(alerts) > 1:
+                text = alert.subject + '\n' + text
+            if suppressed[alert.key]:
+                text += '\n(%d more like this were suppressed)' % suppressed[alert.key]
+            parts.append(text)
+        body = '\n\n'.join(parts) + '\n'
+
+        for transport in self.transports:
+            try:
+                transport.send(subject, body)
+            except Exception as e:
+                with self.__condition:
+                    self.errors += 1
+                ALERTS.inc(len(alerts), result='error')
+                self.__logger.warning('Failed to send %s through %s: %s' % (subject, type(transport).__name__, e))
+                continue
+            ALERTS.inc(len(alerts), result='sent')
+
+        with self.__condition:
+            self.sent += len(alerts)
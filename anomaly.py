@@ -0,0 +1,159 @@
+from collections import namedtuple
+
+RULE_TYPES = ('rate', 'zscore', 'band', 'flatline')
+
+
+class Rule(namedtuple('Rule', ['name', 'field', 'type', 'window', 'threshold', 'low', 'high', 'min_samples'])):
+    '''
+    One check on one field over the last window seconds:
+
+    rate      the field changed by more than threshold per hour
+    zscore    the latest value is more than threshold standard deviations from the rest of the window
+    band      every value in the window was outside low..high
+    flatline  the field moved by no more than threshold over the whole window, the sensor is stuck
+
+    A rule needs at least min_samples readings in its window before it can fire.
+    '''
+    __slots__ = ()
+
+class Alert(namedtuple('Alert', ['rule', 'value', 'timestamp'])):
+    '''
+    A rule that started firing, with the value that tripped it
+    '''
+    __slots__ = ()
+
+    def __str__(self):
+        rule = self.rule
+        if rule.type == 'rate':
+            return '%s changing by %.3g per hour' % (rule.field, self.value)
+        if rule.type == 'zscore':
+            return '%s is %.3g standard deviations from the last %d seconds' % (rule.field, self.value, rule.window)
+        if rule.type == 'band':
+            bounds = tuple('' if bound is None else '%g' % bound for bound in (rule.low, rule.high))
+            return '%s has been outside %s..%s for %d seconds, now %g' % ((rule.field,) + bounds + (rule.window, self.value))
+        return '%s has only moved by %g in %d seconds' % (rule.field, self.value, rule.window)
+
+def check_rules(fields, rules):
+    '''
+    Raise ValueError for a rule that can't be evaluated against fields
+    '''
+    for rule in rules:
+        if rule.field not in fields:
+            raise ValueError('Rule %s checks unknown field %s' % (rule.name, rule.field))
+        if rule.type not in RULE_TYPES:
+            raise ValueError('Rule %s has unknown type %s' % (rule.name, rule.type))
+
+class AnomalyDetector:
+    '''
+    The last capacity readings of a few fields in a numpy ring buffer, with
+    every rule evaluated against it in one vectorized pass.
+
+    Rules are edge triggered: one is only reported when it starts firing,
+    and again once it has cleared. Missing values (None) are ignored.
+    '''
+    def __init__(self, fields, rules, capacity=1440):
+        import numpy
+
+        self.fields = list(fields)
+        self.rules = list(rules)
+        self.capacity = capacity
+        self.__timestamps = numpy.zeros(capacity)
+        self.__values = numpy.full((capacity, len(self.fields)), numpy.nan)
+        self.__count = 0
+        self.__index = 0
+
+        check_rules(self.fields, self.rules)
+
+        # Each rule's parameters as arrays, one entry per rule
+        self.__columns = numpy.array([self.fields.index(rule.field) for rule in self.rules], dtype=int)
+        self.__types = numpy.array([rule.type for rule in self.rules])
+        self.__windows = numpy.array([rule.window for rule in self.rules], dtype=float)
+        # Without a threshold a flatline means not moving at all, the other types never fire
+        self.__thresholds = numpy.array([rule.threshold if rule.threshold is not None else 0.0 if rule.type == 'flatline' else numpy.nan
+            for rule in self.rules], dtype=float)
+        self.__lows = numpy.array([-numpy.inf if rule.low is None else rule.low for rule in self.rules], dtype=float)
+        self.__highs = numpy.array([numpy.inf if rule.high is None else rule.high for rule in self.rules], dtype=float)
+        self.__min_samples = numpy.array([rule.min_samples for rule in self.rules], dtype=int)
+        self.__active = numpy.zeros(len(self.rules), dtype=bool)
+
+    def __len__(self):
+        return self.__count
+
+    def add(self, timestamp, values):
+        '''
+        Add a reading, values are in the same order as fields
+        '''
+        import numpy
+
+        self.__timestamps[self.__index] = timestamp
+        self.__values[self.__index] = [numpy.nan if value is None else value for value in values]
+        self.__index = (self.__index + 1) % self.capacity
+        self.__count = min(self.__count + 1, self.capacity)
+
+    def evaluate(self):
+        '''
+        Check every rule against the window ending at the latest reading.
+        Returns the alerts for rules that started firing and the rules that cleared.
+        '''
+        import numpy
+
+        if not self.rules or self.__count == 0:
+            return [], []
+
+        # Oldest first
+        order = (numpy.arange(self.__count) + self.__index - self.__count) % self.capacity
+        timestamps = self.__timestamps[order]
+        now = timestamps[-1]
+        rows = numpy.arange(len(self.rules))
+
+        # One row per rule, one column per reading
+        values = self.__values[order][:, self.__columns].T
+        valid = (timestamps >= (now - self.__windows)[:, None]) & ~numpy.isnan(values)
+        count = valid.sum(axis=1)
+        # A window is only fully seen once we have a reading from before it started
+        covered = timestamps[0] <= now - self.__windows
+
+        first = valid.argmax(axis=1)
+        last = values.shape[1] - 1 - valid[:, ::-1].argmax(axis=1)
+        latest = values[rows, last]
+
+        # The window without its latest value, to compare the latest value against
+        baseline = valid.copy()
+        baseline[rows, last] = False
+        baseline_count = baseline.sum(axis=1)
+
+        with numpy.errstate(all='ignore'):
+            elapsed = timestamps[last] - timestamps[first]
+            rate = (latest - values[rows, first]) / elapsed * 3600
+
+            mean = numpy.where(baseline, values, 0.0).sum(axis=1) / baseline_count
+            std = numpy.sqrt(numpy.where(baseline, (values - mean[:, None]) ** 2, 0.0).sum(axis=1) / baseline_count)
+            zscore = (latest - mean) / std
+
+            outside = valid & ((values < self.__lows[:, None]) | (values > self.__highs[:, None]))
+            spread = numpy.where(valid, values, -numpy.inf).max(axis=1) - numpy.where(valid, values, numpy.inf).min(axis=1)
+
+            enough = count >= self.__min_samples
+            firing = numpy.select([
+                self.__types == 'rate',
+                self.__types == 'zscore',
+                self.__types == 'band',
+                self.__types == 'flatline',
+            ], [
+                (count >= numpy.maximum(self.__min_samples, 2)) & (elapsed > 0) & (numpy.abs(rate) > self.__thresholds),
+                (baseline_count >= self.__min_samples) & (std > 0) & (numpy.abs(zscore) > self.__thresholds),
+                enough & covered & (outside.sum(axis=1) == count),
+                enough & covered & (spread <= self.__thresholds),
+            ], False)
+            statistic = numpy.select([
+                self.__types == 'rate',
+                self.__types == 'zscore',
+                self.__types == 'band',
+            ], [rate, zscore, latest], spread)
+
+        started = firing & ~self.__active
+        cleared = self.__active & ~firing
+        self.__active = firing
+
+        alerts = [Alert(self.rules[i], float(statistic[i]), float(now)) for i in numpy.flatnonzero(started)]
+        return alerts, [self.rules[i] for i in numpy.flatnonzero(cleared)]
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark the HTTP resources, the scheduled jobs and the AtlasI2C decode path
+against in-process fakes of the GPIO pins, the I2C device file and the
+one-wire sensor, so it runs anywhere without hardware.
+
+    ./bench.py --json results.json
+    ./bench.py --compare results.json
+
+Each case reports throughput, p50/p99 latency, CPU time per operation and
+how much the RSS grew while it ran. The fakes sleep for the configured
+latencies on every access, set them to what the Pi's buses actually take to
+see how much of a request is spent waiting on hardware. --compare prints the
+change against a saved run and exits with status 1 if any case's p50 or p99
+got worse by more than --threshold.
+'''
+
+import argparse
+import configparser
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+import hardware
+
+
+class FakeGPIO:
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self, latency, inputs=None):
+        self.latency = latency
+        # pin: level, anything not listed reads high (the float switch says full)
+        self.inputs = inputs or {}
+        self.outputs = {}
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, channel, direction, **kwargs):
+        pass
+
+    def output(self, channel, value):
+        time.sleep(self.latency)
+        self.outputs[channel] = int(value)
+
+    def input(self, channel):
+        time.sleep(self.latency)
+        return self.inputs.get(channel, self.HIGH)
+
+    def add_event_detect(self, channel, edge, callback=None, **kwargs):
+        pass
+
+    def cleanup(self, *args):
+        pass
+
+class FakeI2CDevice:
+    '''
+    Answers every read with a successful pH reading
+    '''
+    def __init__(self, bus, latency, response=b'\x017.012\x00'):
+        self.bus = bus
+        self.latency = latency
+        self.response = response.ljust(31, b'\x00')
+
+    def set_address(self, address):
+        pass
+
+    def read(self, num_of_bytes):
+        time.sleep(self.latency)
+        return self.response[:num_of_bytes]
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def write(self, data):
+        time.sleep(self.latency)
+        return len(data)
+
+    def close(self):
+        pass
+
+class FakeTemperatureSensor:
+    def __init__(self, serial, latency, value=25.5):
+        self.serial = serial
+        self.latency = latency
+        self.value = value
+
+    def set_resolution(self, resolution):
+        pass
+
+    def get_temperature(self):
+        # The conversion time
+        time.sleep(self.latency)
+        return self.value
+
+class FakeBackend:
+    def __init__(self, gpio_latency=0, i2c_latency=0, onewire_latency=0):
+        self.gpio = FakeGPIO(gpio_latency)
+        self.i2c_latency = i2c_latency
+        self.onewire_latency = onewire_latency
+
+    def open_i2c(self, bus):
+        return FakeI2CDevice(bus, self.i2c_latency)
+
+    def temperature_sensor(self, serial):
+        return FakeTemperatureSensor(serial, self.onewire_latency)
+
+def rss():
+    # Current resident set size in bytes
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+        # Not Linux, the peak is the best we have (kilobytes on Linux, bytes on macOS)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+def measure(run, iterations, warmup, reset=None):
+    '''
+    Time iterations calls of run(), after warmup untimed ones. reset() runs
+    between calls to put things back and isn't counted.
+    '''
+    for _ in range(warmup):
+        run()
+        if reset is not None:
+            reset()
+
+    latencies = []
+    rss_before = rss()
+    cpu = 0.0
+    elapsed = 0.0
+    for _ in range(iterations):
+        cpu_started = time.process_time()
+        started = time.perf_counter()
+        run()
+        latency = time.perf_counter() - started
+        cpu += time.process_time() - cpu_started
+        elapsed += latency
+        latencies.append(latency)
+        if reset is not None:
+            reset()
+    rss_after = rss()
+
+    latencies.sort()
+    return {
+        'iterations': iterations,
+        'throughput': iterations / elapsed if elapsed > 0 else None,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'max': latencies[-1] if latencies else None,
+        'cpu_per_op': cpu / iterations if iterations else None,
+        'rss': rss_after,
+        'rss_growth': rss_after - rss_before,
+    }
+
+def expect(response, status=200):
+    if response.status_code != status:
+        raise RuntimeError('%s %s returned %d: %s' % (response.request.method, response.request.path,
+            response.status_code, response.get_data(as_text=True)))
+
+def make_cases(tank_monitor, AtlasI2C):
+    '''
+    name: (run, reset), in the order they run
+    '''
+    client = tank_monitor.app.test_client()
+    tank = tank_monitor.tanks[tank_monitor.tank_names[0]]
+    drain = tank.valves['drain'].device_name
+    light = tank.light.device_name
+    board = tank.ph_sensor.init()
+    light_states = [1, 2]
+    gpio = hardware.backend.gpio
+    water_level_gpio = tank_monitor.config.getint('tank:' + tank.name, 'water_level_gpio',
+        fallback=tank_monitor.tank_defaults['water_level_gpio'])
+
+    def get(path):
+        return lambda: expect(client.get(path))
+
+    def toggle_light():
+        light_states.reverse()
+        expect(client.post('/light/' + light, json={ 'state': light_states[0] }))
+
+    def top_off():
+        # The float switch says the tank is low, so this opens the fill valve
+        gpio.inputs[water_level_gpio] = gpio.LOW
+        tank.top_off()
+
+    def top_off_reset():
+        gpio.inputs[water_level_gpio] = gpio.HIGH
+        fill = tank.valves['fill']
+        if not fill.is_open():
+            raise RuntimeError('top_off did not open the fill valve')
+        fill.close()
+
+    response = bytearray(b'\x01?I,pH,2.10\x00'.ljust(AtlasI2C.AtlasI2C.max_response, b'\x00'))
+    def decode():
+        AtlasI2C.decode(response, len(response))
+
+    cases = {
+        'get_temperature': (get('/temperature/' + tank.name), None),
+        'get_temperature_fresh': (get('/temperature/' + tank.name + '?fresh=1'), None),
+        'get_ph': (get('/ph/' + tank.name), None),
+        'get_ph_fresh': (get('/ph/' + tank.name + '?fresh=1'), None),
+        'get_valve': (get('/valve/' + drain), None),
+        'post_valve': (lambda: expect(client.post('/valve/' + drain, json={ 'state': 'open' })),
+            lambda: tank.valves['drain'].close()),
+        'get_light': (get('/light/' + light), None),
+        'post_light': (toggle_light, None),
+        'post_change_water': (lambda: expect(client.post('/action/change_water', json={ 'time': 120, 'tank': tank.name })),
+            tank.stop),
+        'log_to_cloud': (tank_monitor.log_to_cloud, None),
+        'top_off': (top_off, top_off_reset),
+        'atlas_read': (board.read, None),
+        'atlas_decode': (decode, None),
+    }
+    return cases
+
+def compare(results, baseline, threshold):
+    '''
+    Print the change in every case against baseline, returns the cases that regressed
+    '''
+    regressed = []
+    print()
+    print('%-24s %12s %12s' % ('against baseline', 'p50', 'p99'))
+    for name, result in results['cases'].items():
+        before = baseline.get('cases', {}).get(name)
+        if before is None:
+            print('%-24s %12s' % (name, 'new'))
+            continue
+        changes = []
+        for key in ('p50', 'p99'):
+            if not before.get(key) or result.get(key) is None:
+                changes.append(None)
+                continue
+            changes.append(result[key] / before[key] - 1)
+        print('%-24s %12s %12s' % ((name,) + tuple('' if change is None else '%+.1f%%' % (change * 100) for change in changes)))
+        if any(change is not None and change > threshold for change in changes):
+            regressed.append(name)
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark tank_monitor against fake hardware')
+    parser.add_argument('--iterations', type=int, default=500, help='timed runs of each case')
+    parser.add_argument('--warmup', type=int, default=20, help='untimed runs of each case before timing it')
+    parser.add_argument('--case', action='append', default=[], help='only run this case, can be repeated')
+    parser.add_argument('--list', action='store_true', help='list the cases and exit')
+    parser.add_argument('--gpio-latency', type=float, default=0, help='seconds every GPIO read or write takes')
+    parser.add_argument('--i2c-latency', type=float, default=0.0002, help='seconds every I2C transfer takes')
+    parser.add_argument('--onewire-latency', type=float, default=0.001, help='seconds a temperature conversion takes')
+    parser.add_argument('--board-delay', type=float, default=0,
+        help='seconds the pH board takes to process a command, the real board takes about 0.9')
+    parser.add_argument('--json', help='save the results here')
+    parser.add_argument('--compare', help='results saved by an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+        help='how much slower (0.1 is 10%%) a case can get before --compare fails')
+    args = parser.parse_args()
+
+    # Keep the benchmark's files out of the real system's paths
+    workdir = tempfile.mkdtemp(prefix='tank_bench_')
+    config = configparser.ConfigParser()
+    config['history'] = { 'path': os.path.join(workdir, 'history.dat') }
+    config['state'] = { 'path': os.path.join(workdir, 'state.json') }
+    config['events'] = { 'journal_path': os.path.join(workdir, 'events') }
+    config['i2c'] = { 'registry_path': os.path.join(workdir, 'i2c_devices.json') }
+    # Logging every top off and water change would be timed along with them
+    config['logging'] = { 'level': 'WARNING' }
+    config_path = os.path.join(workdir, 'tank_monitor.conf')
+    with open(config_path, 'w') as f:
+        config.write(f)
+    os.environ['TANK_MONITOR_CONF'] = config_path
+
+    hardware.backend = FakeBackend(args.gpio_latency, args.i2c_latency, args.onewire_latency)
+
+    import AtlasI2C
+    AtlasI2C.AtlasI2C.long_delay = AtlasI2C.AtlasI2C.short_delay = args.board_delay
+
+    rss_before_import = rss()
+    import tank_monitor
+    rss_after_import = rss()
+
+    cases = make_cases(tank_monitor, AtlasI2C)
+    if args.list:
+        for name in cases:
+            print(name)
+        return
+    unknown = [name for name in args.case if name not in cases]
+    if unknown:
+        parser.error('unknown case: ' + ', '.join(unknown))
+
+    results = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'settings': {
+            'iterations': args.iterations,
+            'gpio_latency': args.gpio_latency,
+            'i2c_latency': args.i2c_latency,
+            'onewire_latency': args.onewire_latency,
+            'board_delay': args.board_delay,
+        },
+        'import_rss_growth': rss_after_import - rss_before_import,
+        'cases': {},
+    }
+
+    print('%-24s %10s %10s %10s %10s %10s %10s' % ('case', 'ops/s', 'p50 ms', 'p99 ms', 'cpu ms/op', 'rss MB', 'rss +KB'))
+    try:
+        for name, (run, reset) in cases.items():
+            if args.case and name not in args.case:
+                continue
+            result = measure(run, args.iterations, args.warmup, reset)
+            results['cases'][name] = result
+            print('%-24s %10.0f %10.3f %10.3f %10.3f %10.1f %10.0f' % (name, result['throughput'] or 0,
+                result['p50'] * 1000, result['p99'] * 1000, result['cpu_per_op'] * 1000,
+                result['rss'] / 2**20, result['rss_growth'] / 1024))
+    finally:
+        tank_monitor.state_store.close()
+        tank_monitor.event_journal.close()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressed = compare(results, baseline, args.threshold)
+        if regressed:
+            print('Slower than the baseline: ' + ', '.join(regressed))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
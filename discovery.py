@@ -0,0 +1,147 @@
+import json
+import logging
+import os
+import threading
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from AtlasI2C import AtlasI2C
+from i2c_bus import I2CBus
+
+# 0x00-0x07 and 0x78-0x7f are reserved by the I2C spec
+SCAN_ADDRESSES = range(0x08, 0x78)
+
+
+class DeviceInfo(namedtuple('DeviceInfo', ['bus', 'address', 'type', 'firmware'])):
+    '''
+    A device that answered on a bus. type and firmware are None if it didn't answer the EZO I command.
+    '''
+    __slots__ = ()
+
+class DeviceRegistry:
+    '''
+    I2C devices found on our buses, cached in a JSON file.
+
+    At startup the cached devices are only probed to check they are still
+    there; a bus is fully rescanned if one of them has gone missing, if it
+    has never been scanned, or when asked to. Buses are scanned in parallel.
+    '''
+    def __init__(self, path, buses, logger=None):
+        self.path = path
+        self.buses = list(buses)
+        self.__devices = {}
+        self.__scanned = set()
+        self.__lock = threading.Lock()
+        self.__logger = logger or logging.getLogger(__name__)
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                cached = json.load(f)
+        except (IOError, ValueError):
+            return
+
+        with self.__lock:
+            for bus, devices in cached.items():
+                bus = int(bus)
+                self.__scanned.add(bus)
+                for device in devices:
+                    info = DeviceInfo(bus, device['address'], device.get('type'), device.get('firmware'))
+                    self.__devices[(bus, info.address)] = info
+
+    def save(self):
+        with self.__lock:
+            cached = {str(bus): [] for bus in self.__scanned}
+            for info in sorted(self.__devices.values()):
+                cached.setdefault(str(info.bus), []).append({
+                    'address': info.address,
+                    'type': info.type,
+                    'firmware': info.firmware,
+                })
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(cached, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def devices(self):
+        with self.__lock:
+            return sorted(self.__devices.values())
+
+    def find(self, device_type, bus=None):
+        '''
+        Find a device by its EZO type (pH, ORP, EC, DO, RTD...), None if there isn't one
+        '''
+        for info in self.devices():
+            if info.type is not None and info.type.lower() == device_type.lower() and (bus is None or info.bus == bus):
+                return info
+        return None
+
+    def discover(self, rescan=False):
+        '''
+        Make sure the registry matches the buses, returns the devices
+        '''
+        with ThreadPoolExecutor(max(len(self.buses), 1), thread_name_prefix='discovery') as pool:
+            list(pool.map(lambda bus: self.__discover_bus(bus, rescan), self.buses))
+        self.save()
+        return self.devices()
+
+    def __discover_bus(self, bus, rescan):
+        try:
+            manager = I2CBus.get(bus)
+        except IOError as e:
+            self.__logger.warning('Skipping I2C bus %d: %s' % (bus, e))
+            return
+
+        with self.__lock:
+            cached = [info for info in self.__devices.values() if info.bus == bus]
+            scanned = bus in self.__scanned
+
+        if scanned and not rescan and all(manager.probe(info.address) for info in cached):
+            # Nothing has gone missing, trust the cache
+            return
+
+        found = self.scan(bus)
+        with self.__lock:
+            for key in [key for key in self.__devices if key[0] == bus]:
+                del self.__devices[key]
+            for info in found:
+                self.__devices[(bus, info.address)] = info
+            self.__scanned.add(bus)
+        self.__logger.info('Found %d devices on I2C bus %d' % (len(found), bus))
+
+    def scan(self, bus):
+        '''
+        Probe every address on a bus and identify whatever answers
+        '''
+        manager = I2CBus.get(bus)
+        addresses = [address for address in SCAN_ADDRESSES if manager.probe(address)]
+
+        # Ask every board at once so they identify themselves in parallel
+        boards = [AtlasI2C(address=address, bus=bus) for address in addresses]
+        futures = []
+        for board in boards:
+            try:
+                futures.append(board.issue('I'))
+            except IOError:
+                futures.append(None)
+
+        found = []
+        for address, future in zip(addresses, futures):
+            device_type = firmware = None
+            try:
+                response = future.result() if future is not None else None
+            except IOError:
+                response = None
+            # EZO boards answer ?I,<type>,<firmware>
+            if response is not None and response.ok():
+                fields = response.fields
+                if len(fields) >= 3 and fields[0].upper() == '?I':
+                    device_type, firmware = fields[1], fields[2]
+            found.append(DeviceInfo(bus, address, device_type, firmware))
+        return found
@@ -0,0 +1,92 @@
+import collections
+import itertools
+import threading
+
+
+class Subscriber:
+    '''
+    One client's pending events. The buffer is bounded; when it is full the
+    oldest event is dropped so a slow client can't hold up anyone else.
+    '''
+    def __init__(self, max_events):
+        self.dropped = 0
+        self.__events = collections.deque(maxlen=max_events)
+        self.__condition = threading.Condition()
+
+    def put(self, event):
+        with self.__condition:
+            if len(self.__events) == self.__events.maxlen:
+                self.dropped += 1
+            self.__events.append(event)
+            self.__condition.notify()
+
+    def get(self, timeout=None):
+        '''
+        Wait for the next event, returns None on timeout
+        '''
+        with self.__condition:
+            if not self.__events:
+                self.__condition.wait(timeout)
+            if self.__events:
+                return self.__events.popleft()
+            return None
+
+class EventBus:
+    '''
+    Fans events out to at most max_subscribers Server-Sent Events subscribers
+    '''
+    def __init__(self, max_events=100, heartbeat=15, max_subscribers=None):
+        self.max_events = max_events
+        self.heartbeat = heartbeat
+        self.max_subscribers = max_subscribers
+        self.__ids = itertools.count(1)
+        self.__subscribers = set()
+        self.__lock = threading.Lock()
+
+    def has_subscribers(self):
+        return bool(self.__subscribers)
+
+    def subscribe(self):
+        '''
+        Returns None if there are already max_subscribers
+        '''
+        subscriber = Subscriber(self.max_events)
+        with self.__lock:
+            if self.max_subscribers is not None and len(self.__subscribers) >= self.max_subscribers:
+                return None
+            self.__subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.__lock:
+            self.__subscribers.discard(subscriber)
+
+    def publish(self, event_type, data):
+        '''
+        Send an event to every subscriber, data should already be JSON encoded
+        '''
+        with self.__lock:
+            subscribers = list(self.__subscribers)
+        if not subscribers:
+            return
+
+        # Format once, every subscriber gets the same bytes
+        event = ('id: %d\nevent: %s\ndata: %s\n\n' % (next(self.__ids), event_type, data)).encode()
+        for subscriber in subscribers:
+            subscriber.put(event)
+
+    def stream(self, subscriber):
+        '''
+        Generator of encoded events for a subscriber, with comments as heartbeats
+        so proxies and clients can tell the connection is still alive
+        '''
+        try:
+            yield b'retry: 5000\n\n'
+            while True:
+                event = subscriber.get(self.heartbeat)
+                if event is None:
+                    yield b': keep-alive\n\n'
+                else:
+                    yield event
+        finally:
+            self.unsubscribe(subscriber)
@@ -0,0 +1,53 @@
+class RollingMedian:
+    '''
+    Median of the last few samples, kept in a fixed-size ring buffer.
+
+    If max_deviation is set, a sample further than that from the current median
+    is treated as a glitch and dropped. A run of rejections as long as the window
+    means the value really moved, so the window is restarted from the new sample.
+
+    numpy is only imported once the first sample arrives, to keep startup quick.
+    '''
+    def __init__(self, size, max_deviation=None):
+        self.size = size
+        self.max_deviation = max_deviation
+        self.rejected = 0
+        self.__buffer = None
+        self.__count = 0
+        self.__index = 0
+        self.__rejected_run = 0
+
+    def __len__(self):
+        return self.__count
+
+    def add(self, value):
+        '''
+        Add a sample, returns False if it was rejected as an outlier
+        '''
+        if self.max_deviation is not None and self.__count >= 3:
+            if abs(value - self.value()) > self.max_deviation:
+                self.rejected += 1
+                self.__rejected_run += 1
+                if self.__rejected_run < self.size:
+                    return False
+                self.clear()
+
+        self.__rejected_run = 0
+        if self.__buffer is None:
+            import numpy
+            self.__buffer = numpy.zeros(self.size)
+        self.__buffer[self.__index] = value
+        self.__index = (self.__index + 1) % self.size
+        self.__count = min(self.__count + 1, self.size)
+        return True
+
+    def value(self):
+        if self.__count == 0:
+            return None
+        import numpy
+        return float(numpy.median(self.__buffer[:self.__count]))
+
+    def clear(self):
+        self.__count = 0
+        self.__index = 0
+        self.__rejected_run = 0
@@ -0,0 +1,617 @@
+'''
+Hardware backends and clocks.
+
+Everything that touches the GPIO pins, the I2C bus or the one-wire bus goes
+through the module level backend, and everything that needs the time goes
+through the module level clock. By default these are the real hardware and
+the wall clock. configure() swaps them out to record a trace of the real
+hardware, or to replay a recorded trace on a virtual clock, which lets the
+control logic run hours of tank behaviour in seconds on any Linux box.
+
+configure() has to be called before tank_monitor is imported.
+'''
+
+import bisect
+import fcntl
+import heapq
+import io
+import itertools
+import json
+import logging
+import threading
+import time
+
+from datetime import datetime
+
+# From i2c-dev.h in i2c-tools
+I2C_SLAVE = 0x703
+
+
+class RealClock:
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        # Never jumps when the wall clock is set, for telling that it was
+        return time.monotonic()
+
+    def now(self):
+        return datetime.now()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def timer(self, delay, function, args=()):
+        timer = threading.Timer(delay, function, args)
+        timer.daemon = True
+        return timer
+
+class VirtualTimer:
+    '''
+    threading.Timer lookalike that fires on a VirtualClock
+    '''
+    def __init__(self, clock, delay, function, args=()):
+        self.daemon = True
+        self.__clock = clock
+        self.__delay = delay
+        self.__function = function
+        self.__args = args
+        self.__event = None
+
+    def start(self):
+        self.__event = self.__clock.call_later(self.__delay, self.__function, *self.__args)
+
+    def cancel(self):
+        if self.__event is not None:
+            self.__event.cancel()
+
+class VirtualEvent:
+    def __init__(self, when, function, args):
+        self.when = when
+        self.function = function
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class VirtualClock:
+    '''
+    Clock that only moves when it is told to.
+
+    Timers and scheduled jobs are queued as events and run_until() runs them in
+    time order, as fast as the code allows. sleep() just moves the clock
+    forward, so anything that was due in the meantime runs late, like it would
+    on the real hardware.
+    '''
+    def __init__(self, start):
+        self.__now = start
+        self.__events = []
+        self.__sequence = itertools.count()
+        self.__lock = threading.RLock()
+
+    def time(self):
+        return self.__now
+
+    def monotonic(self):
+        return self.__now
+
+    def now(self):
+        return datetime.fromtimestamp(self.__now)
+
+    def sleep(self, seconds):
+        with self.__lock:
+            self.__now += max(seconds, 0)
+
+    def timer(self, delay, function, args=()):
+        return VirtualTimer(self, delay, function, args)
+
+    def call_at(self, when, function, *args):
+        event = VirtualEvent(when, function, args)
+        with self.__lock:
+            heapq.heappush(self.__events, (when, next(self.__sequence), event))
+        return event
+
+    def call_later(self, delay, function, *args):
+        return self.call_at(self.__now + delay, function, *args)
+
+    def run_until(self, end):
+        while True:
+            with self.__lock:
+                if not self.__events or self.__events[0][0] > end:
+                    self.__now = max(self.__now, end)
+                    return
+                when, sequence, event = heapq.heappop(self.__events)
+                self.__now = max(self.__now, when)
+            if not event.cancelled:
+                event.function(*event.args)
+
+class VirtualJob:
+    def __init__(self, scheduler, id, func, args, kwargs, period, first_run):
+        self.id = id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.period = period
+        self.next_run_time = first_run
+        self.__scheduler = scheduler
+        self.__event = None
+
+    def schedule(self, clock):
+        self.__event = clock.call_at(self.next_run_time, self.__run, clock)
+
+    def cancel(self):
+        if self.__event is not None:
+            self.__event.cancel()
+
+    def __run(self, clock):
+        # Queue the next run first, the job may remove itself
+        scheduled = self.next_run_time
+        self.next_run_time = scheduled + self.period
+        self.schedule(clock)
+        self.__scheduler.run_job(self, scheduled)
+
+class VirtualScheduler:
+    '''
+    Runs jobs on a VirtualClock with the parts of the APScheduler API we use.
+    Only interval triggers (optionally with a start_date) and cron triggers
+    on every minute are supported.
+    '''
+    def __init__(self, clock, logger=None):
+        self.clock = clock
+        self.running = False
+        self.__jobs = {}
+        self.__pending = []
+        self.__listeners = []
+        self.__ids = itertools.count(1)
+        self.__logger = logger or logging.getLogger(__name__)
+
+    def __period(self, trigger, trigger_args):
+        if trigger == 'interval':
+            period = (trigger_args.get('weeks', 0) * 604800 + trigger_args.get('days', 0) * 86400 +
+                      trigger_args.get('hours', 0) * 3600 + trigger_args.get('minutes', 0) * 60 +
+                      trigger_args.get('seconds', 0))
+            start_date = trigger_args.get('start_date')
+            if start_date is None:
+                return period, None
+            # Like APScheduler, fire on start_date and every period after it
+            first = start_date.timestamp() if isinstance(start_date, datetime) else start_date
+            now = self.clock.time()
+            if first < now:
+                first += -((first - now) // period) * period
+            return period, first
+        if trigger == 'cron' and str(trigger_args.get('minute')) == '*' and set(trigger_args) <= {'minute', 'second'}:
+            # Every minute, on the given second
+            second = int(trigger_args.get('second', 0))
+            now = self.clock.time()
+            first = now - (now % 60) + second
+            if first <= now:
+                first += 60
+            return 60, first
+        raise ValueError('Unsupported trigger for virtual scheduler: %s %r' % (trigger, trigger_args))
+
+    def add_job(self, func, trigger=None, args=None, kwargs=None, id=None, next_run_time=None,
+                replace_existing=False, **trigger_args):
+        from apscheduler.jobstores.base import ConflictingIdError
+
+        # Options that only matter to the real scheduler
+        for option in ('name', 'misfire_grace_time', 'coalesce', 'max_instances', 'jobstore', 'executor'):
+            trigger_args.pop(option, None)
+
+        if id is None:
+            id = 'job_%d' % next(self.__ids)
+        if id in self.__jobs:
+            if not replace_existing:
+                raise ConflictingIdError(id)
+            self.remove_job(id)
+
+        period, first_run = self.__period(trigger, trigger_args)
+        if next_run_time is not None:
+            first_run = next_run_time.timestamp() if isinstance(next_run_time, datetime) else next_run_time
+        elif first_run is None:
+            first_run = self.clock.time() + period
+
+        job = VirtualJob(self, id, func, args or (), kwargs or {}, period, first_run)
+        self.__jobs[id] = job
+        if self.running:
+            job.schedule(self.clock)
+        else:
+            self.__pending.append(job)
+        return job
+
+    def scheduled_job(self, trigger, **kwargs):
+        def decorator(func):
+            self.add_job(func, trigger, **kwargs)
+            return func
+        return decorator
+
+    def get_job(self, id):
+        return self.__jobs.get(id)
+
+    def get_jobs(self):
+        return list(self.__jobs.values())
+
+    def remove_job(self, id):
+        from apscheduler.jobstores.base import JobLookupError
+
+        job = self.__jobs.pop(id, None)
+        if job is None:
+            raise JobLookupError(id)
+        job.cancel()
+
+    def add_listener(self, callback, mask=None):
+        self.__listeners.append((callback, mask))
+
+    def run_job(self, job, scheduled):
+        from apscheduler.events import EVENT_JOB_SUBMITTED, JobSubmissionEvent
+
+        # Jobs start the moment they are submitted here, so listeners see no lag
+        event = JobSubmissionEvent(EVENT_JOB_SUBMITTED, job.id, 'default', [datetime.fromtimestamp(scheduled)])
+        for callback, mask in self.__listeners:
+            if mask is None or mask & EVENT_JOB_SUBMITTED:
+                callback(event)
+
+        try:
+            job.func(*job.args, **job.kwargs)
+        except Exception:
+            self.__logger.exception('Job %s failed' % job.id)
+
+    def start(self):
+        self.running = True
+        for job in self.__pending:
+            if self.__jobs.get(job.id) is job:
+                job.schedule(self.clock)
+        self.__pending = []
+
+    def shutdown(self, wait=True):
+        self.running = False
+        for job in self.__jobs.values():
+            job.cancel()
+
+class I2CDevice:
+    '''
+    The /dev/i2c-N character device for one bus
+    '''
+    def __init__(self, bus):
+        self.bus = bus
+        self.__file = io.open('/dev/i2c-' + str(bus), 'r+b', buffering=0)
+
+    def set_address(self, address):
+        fcntl.ioctl(self.__file, I2C_SLAVE, address)
+
+    def read(self, num_of_bytes):
+        return self.__file.read(num_of_bytes)
+
+    def readinto(self, buffer):
+        return self.__file.readinto(buffer)
+
+    def write(self, data):
+        return self.__file.write(data)
+
+    def close(self):
+        self.__file.close()
+
+class TemperatureSensor:
+    '''
+    A DS18B20 on the one-wire bus
+    '''
+    def __init__(self, serial):
+        from w1thermsensor import W1ThermSensor
+        self.serial = serial
+        self.__sensor = W1ThermSensor(W1ThermSensor.THERM_SENSOR_DS18B20, serial)
+
+    def set_resolution(self, resolution):
+        self.__sensor.set_resolution(resolution)
+
+    def get_temperature(self):
+        # Degrees C
+        return self.__sensor.get_temperature()
+
+class RealBackend:
+    def __init__(self):
+        self.__gpio = None
+
+    @property
+    def gpio(self):
+        # Only import this on first use, it can't be imported off a Pi
+        if self.__gpio is None:
+            import RPi.GPIO
+            self.__gpio = RPi.GPIO
+        return self.__gpio
+
+    def open_i2c(self, bus):
+        return I2CDevice(bus)
+
+    def temperature_sensor(self, serial):
+        return TemperatureSensor(serial)
+
+class TraceWriter:
+    '''
+    Appends trace records as JSON lines
+    '''
+    def __init__(self, path, clock):
+        self.__file = open(path, 'a', buffering=1)
+        self.__clock = clock
+        self.__lock = threading.Lock()
+
+    def record(self, kind, key, value):
+        if isinstance(value, (bytes, bytearray)):
+            value = bytes(value).hex()
+        line = json.dumps({ 't': self.__clock.time(), 'kind': kind, 'key': key, 'value': value })
+        with self.__lock:
+            self.__file.write(line + '\n')
+
+class RecordingGPIO:
+    '''
+    RPi.GPIO wrapper that records inputs and outputs
+    '''
+    def __init__(self, gpio, trace):
+        self.__gpio = gpio
+        self.__trace = trace
+
+    def __getattr__(self, name):
+        # Constants and anything we don't need to record
+        return getattr(self.__gpio, name)
+
+    def setup(self, channel, direction, **kwargs):
+        self.__gpio.setup(channel, direction, **kwargs)
+
+    def output(self, channel, value):
+        self.__gpio.output(channel, value)
+        self.__trace.record('gpio_out', channel, int(value))
+
+    def input(self, channel):
+        value = self.__gpio.input(channel)
+        self.__trace.record('gpio_in', channel, int(value))
+        return value
+
+    def add_event_detect(self, channel, edge, callback=None, **kwargs):
+        def recorded_callback(channel):
+            # Capture the level at the edge so replay can raise the same edge
+            self.input(channel)
+            if callback is not None:
+                callback(channel)
+        self.__gpio.add_event_detect(channel, edge, callback=recorded_callback, **kwargs)
+
+class RecordingI2CDevice:
+    def __init__(self, device, trace):
+        self.__device = device
+        self.__trace = trace
+        self.__address = None
+
+    def set_address(self, address):
+        self.__device.set_address(address)
+        self.__address = address
+
+    def read(self, num_of_bytes):
+        data = self.__device.read(num_of_bytes)
+        self.__trace.record('i2c_read', '%d/%d' % (self.__device.bus, self.__address), data)
+        return data
+
+    def readinto(self, buffer):
+        count = self.__device.readinto(buffer)
+        self.__trace.record('i2c_read', '%d/%d' % (self.__device.bus, self.__address), buffer[:count])
+        return count
+
+    def write(self, data):
+        result = self.__device.write(data)
+        self.__trace.record('i2c_write', '%d/%d' % (self.__device.bus, self.__address), data)
+        return result
+
+class RecordingTemperatureSensor:
+    def __init__(self, sensor, trace):
+        self.__sensor = sensor
+        self.__trace = trace
+
+    def set_resolution(self, resolution):
+        self.__sensor.set_resolution(resolution)
+
+    def get_temperature(self):
+        value = self.__sensor.get_temperature()
+        self.__trace.record('w1', self.__sensor.serial, value)
+        return value
+
+class RecordingBackend:
+    '''
+    The real hardware, with every input and output appended to a trace file
+    '''
+    def __init__(self, path, clock):
+        self.__real = RealBackend()
+        self.__trace = TraceWriter(path, clock)
+        self.__gpio = None
+
+    @property
+    def gpio(self):
+        if self.__gpio is None:
+            self.__gpio = RecordingGPIO(self.__real.gpio, self.__trace)
+        return self.__gpio
+
+    def open_i2c(self, bus):
+        return RecordingI2CDevice(self.__real.open_i2c(bus), self.__trace)
+
+    def temperature_sensor(self, serial):
+        return RecordingTemperatureSensor(self.__real.temperature_sensor(serial), self.__trace)
+
+class Trace:
+    '''
+    A recorded trace, indexed by kind and key for lookups by time
+    '''
+    def __init__(self, path):
+        self.__series = {}
+        self.start = None
+        self.end = None
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                series = self.__series.setdefault((record['kind'], str(record['key'])), ([], []))
+                series[0].append(record['t'])
+                series[1].append(record['value'])
+                self.start = record['t'] if self.start is None else min(self.start, record['t'])
+                self.end = record['t'] if self.end is None else max(self.end, record['t'])
+
+        # Traces from several threads can be slightly out of order
+        for key, (times, values) in self.__series.items():
+            order = sorted(range(len(times)), key=times.__getitem__)
+            self.__series[key] = ([times[i] for i in order], [values[i] for i in order])
+
+    def value_at(self, kind, key, when, default=None):
+        '''
+        The last value recorded at or before when, or the first one if there is none yet
+        '''
+        series = self.__series.get((kind, str(key)))
+        if not series:
+            return default
+        times, values = series
+        index = bisect.bisect_right(times, when) - 1
+        return values[max(index, 0)]
+
+    def changes(self, kind, key):
+        '''
+        Yield (time, value) for every change in a series
+        '''
+        times, values = self.__series.get((kind, str(key)), ([], []))
+        previous = None
+        for when, value in zip(times, values):
+            if value != previous:
+                yield when, value
+            previous = value
+
+class ReplayGPIO:
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self, backend):
+        self.__backend = backend
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, channel, direction, **kwargs):
+        pass
+
+    def output(self, channel, value):
+        self.__backend.output('gpio_out', channel, int(value))
+
+    def input(self, channel):
+        return self.__backend.trace.value_at('gpio_in', channel, self.__backend.clock.time(), 0)
+
+    def add_event_detect(self, channel, edge, callback=None, **kwargs):
+        if callback is None:
+            return
+        for when, value in self.__backend.trace.changes('gpio_in', channel):
+            if (edge == self.BOTH or (edge == self.RISING and value) or (edge == self.FALLING and not value)):
+                self.__backend.clock.call_at(when, callback, channel)
+
+    def cleanup(self, *args):
+        pass
+
+class ReplayI2CDevice:
+    def __init__(self, backend, bus):
+        self.bus = bus
+        self.__backend = backend
+        self.__address = None
+
+    def set_address(self, address):
+        self.__address = address
+
+    def read(self, num_of_bytes):
+        data = self.__backend.trace.value_at('i2c_read', '%d/%d' % (self.bus, self.__address), self.__backend.clock.time())
+        if data is None:
+            # Nothing ever answered at this address
+            raise IOError('No I2C device at %d' % self.__address)
+        return bytes.fromhex(data)[:num_of_bytes]
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def write(self, data):
+        self.__backend.output('i2c_write', '%d/%d' % (self.bus, self.__address), bytes(data).hex())
+        return len(data)
+
+class ReplayTemperatureSensor:
+    def __init__(self, backend, serial):
+        self.serial = serial
+        self.__backend = backend
+
+    def set_resolution(self, resolution):
+        pass
+
+    def get_temperature(self):
+        value = self.__backend.trace.value_at('w1', self.serial, self.__backend.clock.time())
+        if value is None:
+            raise IOError('No temperature recorded for sensor %s' % self.serial)
+        return value
+
+class ReplayBackend:
+    '''
+    Answers inputs from a recorded trace at the virtual clock's time and
+    collects every output the control code makes in outputs
+    '''
+    def __init__(self, trace, clock):
+        self.trace = trace
+        self.clock = clock
+        self.outputs = []
+        self.gpio = ReplayGPIO(self)
+
+    def output(self, kind, key, value):
+        self.outputs.append((self.clock.time(), kind, key, value))
+
+    def open_i2c(self, bus):
+        return ReplayI2CDevice(self, bus)
+
+    def temperature_sensor(self, serial):
+        return ReplayTemperatureSensor(self, serial)
+
+clock = RealClock()
+backend = RealBackend()
+
+def configure(mode, trace=None):
+    '''
+    Pick the backend: 'real', 'record' (real hardware, appending to the trace
+    file) or 'replay' (the trace file on a virtual clock). Returns the backend.
+    '''
+    global backend, clock
+
+    if mode == 'real':
+        clock = RealClock()
+        backend = RealBackend()
+    elif mode == 'record':
+        clock = RealClock()
+        backend = RecordingBackend(trace, clock)
+    elif mode == 'replay':
+        recorded = Trace(trace)
+        if recorded.start is None:
+            raise ValueError('Trace %s is empty' % trace)
+        clock = VirtualClock(recorded.start)
+        backend = ReplayBackend(recorded, clock)
+    else:
+        raise ValueError('Unknown hardware mode: ' + mode)
+    return backend
+
+def make_scheduler(executors=None):
+    '''
+    A scheduler that runs on the current clock. executors maps executor
+    names to how many threads each gets, jobs pick one with executor=<name>.
+    '''
+    if isinstance(clock, VirtualClock):
+        return VirtualScheduler(clock)
+
+    from apscheduler.executors.pool import ThreadPoolExecutor
+    from apscheduler.schedulers.background import BackgroundScheduler
+    pools = {name: ThreadPoolExecutor(threads) for name, threads in (executors or {}).items()}
+    return BackgroundScheduler(executors=pools, daemon=True)
@@ -0,0 +1,146 @@
+import math
+import mmap
+import os
+import struct
+import threading
+
+MAGIC = b'TANKHIS1'
+
+# magic, number of fields, capacity, next record to write, records stored
+HEADER = struct.Struct('<8sIIQQ')
+
+
+class HistoryStore:
+    '''
+    Fixed-width sensor history in a memory-mapped ring file.
+
+    Each record is a float64 timestamp followed by one float32 per field (NaN
+    when there was no value). Once the file holds capacity records the oldest
+    ones are overwritten, so the file never grows. Records are written in time
+    order, which lets range queries binary search instead of scanning.
+
+    A file with a different layout than requested is started over.
+    '''
+    def __init__(self, path, fields, capacity, flush_every=10):
+        self.path = path
+        self.fields = list(fields)
+        self.capacity = capacity
+        self.__record = struct.Struct('<d' + 'f' * len(self.fields))
+        self.__flush_every = flush_every
+        self.__unflushed = 0
+        self.__lock = threading.Lock()
+
+        size = HEADER.size + self.__record.size * capacity
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            self.__map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        magic, field_count, file_capacity, self.__head, self.__count = HEADER.unpack_from(self.__map, 0)
+        if magic != MAGIC or field_count != len(self.fields) or file_capacity != capacity:
+            self.__head = 0
+            self.__count = 0
+            self.__write_header()
+            self.__map.flush()
+
+    def __len__(self):
+        return self.__count
+
+    def __write_header(self):
+        HEADER.pack_into(self.__map, 0, MAGIC, len(self.fields), self.capacity, self.__head, self.__count)
+
+    def __offset(self, index):
+        # index counts from the oldest record stored
+        slot = (self.__head - self.__count + index) % self.capacity
+        return HEADER.size + slot * self.__record.size
+
+    def __timestamp(self, index):
+        return struct.unpack_from('<d', self.__map, self.__offset(index))[0]
+
+    def append(self, timestamp, values):
+        values = [math.nan if v is None else float(v) for v in values]
+        with self.__lock:
+            slot = self.__head % self.capacity
+            self.__record.pack_into(self.__map, HEADER.size + slot * self.__record.size, timestamp, *values)
+            self.__head = (self.__head + 1) % self.capacity
+            self.__count = min(self.__count + 1, self.capacity)
+            self.__write_header()
+
+            # Let the page cache batch up writes to the SD card
+            self.__unflushed += 1
+            if self.__unflushed >= self.__flush_every:
+                self.__map.flush()
+                self.__unflushed = 0
+
+    def __bisect(self, timestamp, inclusive=False):
+        # Number of records before timestamp (or at it, if inclusive)
+        low, high = 0, self.__count
+        while low < high:
+            middle = (low + high) // 2
+            current = self.__timestamp(middle)
+            if current < timestamp or (inclusive and current == timestamp):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def points(self, field, start, end, chunk=256):
+        '''
+        Yield (timestamp, value) for field between start and end, skipping missing values
+        '''
+        column = self.fields.index(field) + 1
+        with self.__lock:
+            first = self.__bisect(start)
+            last = self.__bisect(end, inclusive=True)
+            oldest = self.__head - self.__count
+
+        # Only hold the lock while copying a chunk out, so appends aren't held up by slow readers
+        for chunk_start in range(first, last, chunk):
+            with self.__lock:
+                records = [
+                    self.__record.unpack_from(self.__map, HEADER.size + ((oldest + index) % self.capacity) * self.__record.size)
+                    for index in range(chunk_start, min(chunk_start + chunk, last))
+                ]
+            for record in records:
+                if not math.isnan(record[column]):
+                    yield record[0], record[column]
+
+    def query(self, field, start, end, step=None):
+        '''
+        Yield (timestamp, value) for field between start and end.
+        With a step, values are averaged into buckets of step seconds.
+        '''
+        if not step:
+            yield from self.points(field, start, end)
+            return
+
+        bucket = None
+        total = 0.0
+        count = 0
+        for timestamp, value in self.points(field, start, end):
+            current = start + ((timestamp - start) // step) * step
+            if current != bucket:
+                if count:
+                    yield bucket, total / count
+                bucket, total, count = current, 0.0, 0
+            total += value
+            count += 1
+        if count:
+            yield bucket, total / count
+
+    def flush(self):
+        with self.__lock:
+            self.__map.flush()
+            self.__unflushed = 0
+
+    def close(self):
+        with self.__lock:
+            self.__map.flush()
+            self.__map.close()
@@ -0,0 +1,180 @@
+import collections
+import threading
+import time
+
+from concurrent.futures import Future
+
+import hardware
+import metrics
+
+TRANSACTION_SECONDS = metrics.histogram('tank_i2c_transaction_seconds', 'Time spent on the I2C bus per transaction', ('bus', 'address'))
+TRANSACTION_ERRORS = metrics.counter('tank_i2c_transaction_errors_total', 'Failed I2C transactions', ('bus', 'address'))
+
+
+class AddressStats:
+    '''
+    Transaction counters for one address on the bus
+    '''
+    def __init__(self):
+        self.transactions = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.total_wait = 0.0
+
+    def record(self, wait, latency, ok):
+        self.transactions += 1
+        if not ok:
+            self.errors += 1
+        self.total_wait += wait
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def as_dict(self):
+        average = self.total_latency / self.transactions if self.transactions else 0.0
+        average_wait = self.total_wait / self.transactions if self.transactions else 0.0
+        return {
+            'transactions': self.transactions,
+            'errors': self.errors,
+            'average_latency': average,
+            'max_latency': self.max_latency,
+            'average_wait': average_wait,
+        }
+
+class I2CBus:
+    '''
+    Owns the only handle on an I2C bus.
+
+    Every transaction runs on the bus's own thread, so concurrent callers can't
+    interleave with each other. Each address has its own queue of commands and
+    the queues are served round-robin, so one busy device can't starve the rest.
+
+    A command to an EZO board is a write, a wait and a read in separate
+    transactions. Whoever holds an address's lock() owns the board for the
+    whole exchange, so nothing else can talk to it in between.
+    '''
+    __buses = {}
+    __buses_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, bus):
+        '''
+        Get the manager for a bus, creating it on first use
+        '''
+        with cls.__buses_lock:
+            manager = cls.__buses.get(bus)
+            if manager is None:
+                manager = cls(bus)
+                cls.__buses[bus] = manager
+            return manager
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.__device = hardware.backend.open_i2c(bus)
+        self.__address = None
+        self.__queues = collections.OrderedDict()
+        self.__stats = collections.defaultdict(AddressStats)
+        self.__locks = collections.defaultdict(threading.Lock)
+        self.__condition = threading.Condition()
+
+        self.__thread = threading.Thread(target=self.__run, name='i2c-' + str(bus), daemon=True)
+        self.__thread.start()
+
+    def lock(self, address):
+        '''
+        The lock held for the whole of an exchange with the device at address.
+        It is a plain Lock, so it can be released from another thread than the one that took it
+        '''
+        with self.__condition:
+            return self.__locks[address]
+
+    def submit(self, address, operation, record=True):
+        '''
+        Queue operation(device) to run against address, returns a Future for its result.
+        Without record it isn't counted in the stats or metrics.
+        '''
+        future = Future()
+        with self.__condition:
+            queue = self.__queues.get(address)
+            if queue is None:
+                queue = self.__queues[address] = collections.deque()
+            queue.append((future, operation, time.monotonic(), record))
+            self.__condition.notify()
+        return future
+
+    def transaction(self, address, operation):
+        return self.submit(address, operation).result()
+
+    def write(self, address, data):
+        return self.transaction(address, lambda device: device.write(data))
+
+    def read(self, address, num_of_bytes):
+        return self.transaction(address, lambda device: device.read(num_of_bytes))
+
+    def probe(self, address):
+        '''
+        Check if anything acknowledges at address, waiting for anyone in the middle of talking to it
+        '''
+        # Probing all of a bus would otherwise give every empty address its own metrics
+        with self.lock(address):
+            try:
+                self.submit(address, lambda device: device.read(1), record=False).result()
+                return True
+            except IOError:
+                return False
+
+    def pending(self):
+        with self.__condition:
+            return sum(len(queue) for queue in self.__queues.values())
+
+    def stats(self):
+        with self.__condition:
+            return {address: stats.as_dict() for address, stats in self.__stats.items()}
+
+    def __next(self):
+        # Take one command from the first address with work, then move that
+        # address to the back of the line
+        for address, queue in self.__queues.items():
+            if queue:
+                self.__queues.move_to_end(address)
+                return address, queue.popleft()
+        return None
+
+    def __select(self, address):
+        # Only tell the kernel about the slave address when it changes
+        if address != self.__address:
+            self.__address = None
+            self.__device.set_address(address)
+            self.__address = address
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                item = self.__next()
+                while item is None:
+                    self.__condition.wait()
+                    item = self.__next()
+            address, (future, operation, queued, record) = item
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            started = time.monotonic()
+            try:
+                self.__select(address)
+                result = operation(self.__device)
+            except Exception as e:
+                ok = False
+                future.set_exception(e)
+            else:
+                ok = True
+                future.set_result(result)
+
+            finished = time.monotonic()
+            if not record:
+                continue
+            with self.__condition:
+                self.__stats[address].record(started - queued, finished - started, ok)
+            TRANSACTION_SECONDS.observe(finished - started, bus=self.bus, address=address)
+            if not ok:
+                TRANSACTION_ERRORS.inc(bus=self.bus, address=address)
@@ -0,0 +1,187 @@
+import logging
+import threading
+
+from datetime import datetime
+
+from apscheduler.events import EVENT_JOB_SUBMITTED
+
+import hardware
+import metrics
+
+JOB_LAG = metrics.histogram('tank_job_lag_seconds', 'How long after their scheduled time jobs actually started', ('job',))
+DEADLINE_MISSES = metrics.counter('tank_job_deadline_misses_total', 'Jobs that started later than their deadline', ('job',))
+
+# Executor for jobs that drive actuators, so they never queue behind telemetry
+SAFETY = 'safety'
+
+
+class JobMonitor:
+    '''
+    Adds jobs to the scheduler and watches how late each one starts.
+
+    A job is due from the moment the scheduler submits it, and the lag is
+    measured when it actually starts running, so time spent queued behind
+    other jobs in its executor counts. Safety jobs run in their own
+    executor. A job that has a deadline and starts (or is still waiting)
+    more than deadline seconds late is reported to on_miss(job_id, lateness, safety)
+    once per run. The job's next run time is checked too, in case the
+    scheduler itself has stalled.
+
+    Scheduled times are wall clock times, so the wall clock being set (a Pi
+    has no RTC, NTP steps it at boot) would make every job look late. When
+    the wall clock moves by more than step_tolerance seconds against the
+    monotonic clock, runs that were scheduled before the step are neither
+    measured nor reported.
+    '''
+    def __init__(self, scheduler, on_miss, check_interval=1, step_tolerance=1, logger=None):
+        self.scheduler = scheduler
+        self.check_interval = check_interval
+        self.step_tolerance = step_tolerance
+        self.__on_miss = on_miss
+        # job id: (deadline, safety)
+        self.__deadlines = {}
+        # job id: scheduled time of a run that was submitted but hasn't started
+        self.__due = {}
+        # job id: when a run started, if it started before we heard it was submitted
+        self.__started = {}
+        # jobs already reported for their current run
+        self.__missed = set()
+        # Wall clock minus monotonic clock, and the wall time the last step was noticed at
+        self.__offset = None
+        self.__stepped = None
+        self.__lock = threading.Lock()
+        self.__logger = logger or logging.getLogger(__name__)
+        self.__thread = None
+        self.__stopped = threading.Event()
+        scheduler.add_listener(self.__submitted, EVENT_JOB_SUBMITTED)
+
+    def add_job(self, func, trigger, id, deadline=None, safety=False, **kwargs):
+        '''
+        Schedule func like scheduler.add_job. Safety jobs run in the safety executor.
+        '''
+        # A late run still runs, but only once however many runs it missed
+        job = self.scheduler.add_job(self.__wrap(id, func), trigger, id=id,
+            executor=SAFETY if safety else 'default', misfire_grace_time=None, coalesce=True, **kwargs)
+        with self.__lock:
+            self.__deadlines[id] = (deadline, safety)
+            self.__due.pop(id, None)
+            self.__started.pop(id, None)
+            self.__missed.discard(id)
+        return job
+
+    def scheduled_job(self, trigger, id, **kwargs):
+        def decorator(func):
+            self.add_job(func, trigger, id, **kwargs)
+            return func
+        return decorator
+
+    def remove_job(self, id):
+        with self.__lock:
+            self.__deadlines.pop(id, None)
+            self.__due.pop(id, None)
+            self.__started.pop(id, None)
+            self.__missed.discard(id)
+        self.scheduler.remove_job(id)
+
+    def __watch_clock(self):
+        offset = hardware.clock.time() - hardware.clock.monotonic()
+        with self.__lock:
+            previous, self.__offset = self.__offset, offset
+            if previous is None or abs(offset - previous) <= self.step_tolerance:
+                return
+            self.__stepped = hardware.clock.time()
+        self.__logger.warning('Wall clock stepped by %.1f seconds, ignoring lag for jobs scheduled before now' % (offset - previous))
+
+    def __before_step(self, scheduled):
+        # Scheduled on the clock as it was before it was set, its lag means nothing
+        stepped = self.__stepped
+        return stepped is not None and scheduled < stepped
+
+    def __submitted(self, event):
+        self.__watch_clock()
+        id = event.job_id
+        scheduled = event.scheduled_run_times[0].timestamp()
+        with self.__lock:
+            if id not in self.__deadlines:
+                return
+            started = self.__started.pop(id, None)
+            if started is None:
+                self.__due.setdefault(id, scheduled)
+                return
+        self.__ran(id, started, scheduled)
+
+    def __wrap(self, id, func):
+        def run(*args, **kwargs):
+            self.__watch_clock()
+            started = hardware.clock.time()
+            with self.__lock:
+                scheduled = self.__due.pop(id, None)
+                if scheduled is None:
+                    # The executor can start us before the scheduler announces
+                    # the submission, the lag is worked out when it does
+                    self.__started[id] = started
+            if scheduled is not None:
+                self.__ran(id, started, scheduled)
+            return func(*args, **kwargs)
+        return run
+
+    def __ran(self, id, started, scheduled):
+        with self.__lock:
+            reported = id in self.__missed
+            self.__missed.discard(id)
+            deadline, safety = self.__deadlines.get(id, (None, False))
+        if self.__before_step(scheduled):
+            return
+        lag = max(started - scheduled, 0)
+        JOB_LAG.observe(lag, job=id)
+        if deadline is not None and lag > deadline and not reported:
+            self.__miss(id, lag, safety)
+
+    def __miss(self, id, lateness, safety):
+        DEADLINE_MISSES.inc(job=id)
+        try:
+            self.__on_miss(id, lateness, safety)
+        except Exception:
+            self.__logger.exception('Deadline miss handler failed for ' + id)
+
+    def check(self):
+        '''
+        Report jobs that are overdue and still haven't started
+        '''
+        self.__watch_clock()
+        now = hardware.clock.time()
+        with self.__lock:
+            deadlines = {id: entry for id, entry in self.__deadlines.items() if entry[0] is not None and id not in self.__missed}
+            due = dict(self.__due)
+
+        for id, (deadline, safety) in deadlines.items():
+            scheduled = due.get(id)
+            if scheduled is None:
+                # Not submitted yet, make sure the scheduler hasn't fallen behind
+                job = self.scheduler.get_job(id)
+                scheduled = getattr(job, 'next_run_time', None)
+                if isinstance(scheduled, datetime):
+                    scheduled = scheduled.timestamp()
+            if scheduled is None or now - scheduled <= deadline or self.__before_step(scheduled):
+                continue
+
+            with self.__lock:
+                if id in self.__missed or id not in self.__deadlines:
+                    continue
+                self.__missed.add(id)
+            self.__miss(id, now - scheduled, safety)
+
+    def start(self):
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run, name='job_monitor', daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+
+    def __run(self):
+        while not self.__stopped.wait(self.check_interval):
+            try:
+                self.check()
+            except Exception:
+                self.__logger.exception('Job monitor check failed')
@@ -0,0 +1,240 @@
+import json
+import logging
+import os
+import struct
+import threading
+import zlib
+
+import hardware
+
+MAGIC = b'TANKEVT1'
+
+# Payload length, CRC32 of everything after it, timestamp, event type.
+# The payload is the device name, a null, then the details as JSON
+RECORD = struct.Struct('<HIdB')
+
+# Stored as their index, only ever add to the end of this
+EVENT_TYPES = (
+    'valve_open',
+    'valve_close',
+    'valve_refused',
+    'light',
+    'float_switch',
+    'fill_complete',
+    'fill_timeout',
+    'drain_timeout',
+    'water_change',
+    'water_change_refused',
+    'water_change_aborted',
+)
+
+
+class Segment:
+    '''
+    What the index knows about one segment file
+    '''
+    def __init__(self, name, size=0, first=None, last=None, types=()):
+        self.name = name
+        self.size = size
+        self.first = first
+        self.last = last
+        self.types = set(types)
+
+    def add(self, timestamp, type, size):
+        self.first = timestamp if self.first is None else min(self.first, timestamp)
+        self.last = timestamp if self.last is None else max(self.last, timestamp)
+        self.types.add(type)
+        self.size += size
+
+    def matches(self, types, start, end):
+        if self.first is None:
+            return False
+        if start is not None and self.last < start:
+            return False
+        if end is not None and self.first > end:
+            return False
+        return types is None or not self.types.isdisjoint(types)
+
+    def to_json(self):
+        return { 'size': self.size, 'first': self.first, 'last': self.last, 'types': sorted(self.types) }
+
+class EventJournal:
+    '''
+    Append-only binary journal of actuator events, split into segment files.
+
+    Each record is a small fixed header (with a CRC) plus the device name and
+    a JSON object of details. A segment is sealed once it reaches
+    segment_size bytes, and the oldest ones are deleted once there are more
+    than max_segments. The index keeps the time range and the event types
+    in every segment, so a query only reads the segments that can match.
+    The index of sealed segments is saved next to them, the segment being
+    written is scanned on startup. A record cut short by a power cut is
+    dropped from the end of the segment.
+    '''
+    def __init__(self, directory, segment_size=256 * 1024, max_segments=64, logger=None):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.index_path = os.path.join(directory, 'index.json')
+        self.__segments = []
+        self.__file = None
+        self.__lock = threading.Lock()
+        self.__logger = logger or logging.getLogger(__name__)
+
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def __path(self, segment):
+        return os.path.join(self.directory, segment.name)
+
+    def load(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            saved = {}
+        except ValueError:
+            self.__logger.warning('Rebuilding unreadable event index %s' % self.index_path)
+            saved = {}
+
+        names = sorted(name for name in os.listdir(self.directory) if name.startswith('events-') and name.endswith('.log'))
+        segments = []
+        for position, name in enumerate(names):
+            entry = saved.get(name)
+            size = os.path.getsize(os.path.join(self.directory, name))
+            if entry is not None and entry['size'] == size and position < len(names) - 1:
+                segments.append(Segment(name, **entry))
+            else:
+                segments.append(self.__scan(name))
+
+        if not segments:
+            segments.append(self.__create(0))
+        self.__segments = segments
+        self.__file = open(self.__path(segments[-1]), 'ab')
+
+    def __scan(self, name):
+        # Index a segment from its records, cutting off a torn one at the end
+        segment = Segment(name, len(MAGIC))
+        path = os.path.join(self.directory, name)
+        with open(path, 'rb') as f:
+            valid = f.read(len(MAGIC)) == MAGIC
+            if valid:
+                for timestamp, type, device, details, size in self.__records(f):
+                    segment.add(timestamp, type, size)
+
+        if not valid:
+            self.__logger.warning('Starting over unreadable event segment %s' % path)
+            with open(path, 'wb') as f:
+                f.write(MAGIC)
+            return segment
+
+        if os.path.getsize(path) != segment.size:
+            self.__logger.warning('Dropping a partly written event from %s' % path)
+            with open(path, 'r+b') as f:
+                f.truncate(segment.size)
+        return segment
+
+    def __create(self, number):
+        segment = Segment('events-%08d.log' % number, len(MAGIC))
+        with open(self.__path(segment), 'wb') as f:
+            f.write(MAGIC)
+        return segment
+
+    def __records(self, f, limit=None):
+        # Yield (timestamp, type, device, details, size) until the end, limit bytes or a bad record
+        read = 0
+        while limit is None or read < limit:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            length, crc, timestamp, type = RECORD.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(header[6:] + payload) != crc:
+                return
+            device, _, details = payload.partition(b'\0')
+            read += RECORD.size + length
+            # A type from a newer version than this one
+            type = EVENT_TYPES[type] if type < len(EVENT_TYPES) else str(type)
+            yield timestamp, type, device.decode(), details, RECORD.size + length
+
+    def record(self, type, device, details=None, timestamp=None):
+        '''
+        Append an event, details is a JSON-able dict
+        '''
+        if timestamp is None:
+            timestamp = hardware.clock.time()
+        payload = device.encode() + b'\0' + (json.dumps(details, separators=(',', ':')).encode() if details else b'')
+        header = struct.pack('<dB', timestamp, EVENT_TYPES.index(type))
+        data = struct.pack('<HI', len(payload), zlib.crc32(header + payload)) + header + payload
+
+        with self.__lock:
+            try:
+                # Unbuffered as far as the OS, the page cache batches up the SD card writes
+                self.__file.write(data)
+                self.__file.flush()
+            except (IOError, OSError) as e:
+                self.__logger.warning('Failed to write %s event for %s: %s' % (type, device, e))
+                return
+            self.__segments[-1].add(timestamp, type, len(data))
+            if self.__segments[-1].size >= self.segment_size:
+                self.__seal()
+
+    def __seal(self):
+        # Start a new segment and drop the oldest ones, called with the lock held
+        try:
+            number = int(self.__segments[-1].name[len('events-'):-len('.log')]) + 1
+            segment = self.__create(number)
+            new_file = open(self.__path(segment), 'ab')
+            os.fsync(self.__file.fileno())
+            self.__file.close()
+            self.__file = new_file
+            self.__segments.append(segment)
+            while len(self.__segments) > self.max_segments:
+                os.remove(self.__path(self.__segments.pop(0)))
+            self.__save_index()
+        except (IOError, OSError) as e:
+            self.__logger.warning('Failed to start a new event segment: %s' % e)
+
+    def __save_index(self):
+        index = { segment.name: segment.to_json() for segment in self.__segments[:-1] }
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.index_path)
+
+    def query(self, types=None, start=None, end=None, device=None):
+        '''
+        Yield the events between start and end, oldest first, as
+        (timestamp, type, device, details). types limits them to those event types.
+        '''
+        types = None if types is None else set(types)
+        with self.__lock:
+            # Only read as far as the segment being written had got, a record after that may be half written
+            segments = [(segment.name, segment.size) for segment in self.__segments if segment.matches(types, start, end)]
+
+        for name, size in segments:
+            try:
+                f = open(os.path.join(self.directory, name), 'rb')
+            except FileNotFoundError:
+                # Dropped since we looked
+                continue
+            with f:
+                f.seek(len(MAGIC))
+                for timestamp, type, record_device, details, _ in self.__records(f, size - len(MAGIC)):
+                    if start is not None and timestamp < start or end is not None and timestamp > end:
+                        continue
+                    if types is not None and type not in types:
+                        continue
+                    if device is not None and record_device != device:
+                        continue
+                    yield timestamp, type, record_device, json.loads(details) if details else {}
+
+    def close(self):
+        with self.__lock:
+            try:
+                os.fsync(self.__file.fileno())
+            except (IOError, OSError):
+                pass
+            self.__file.close()
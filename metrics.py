@@ -0,0 +1,158 @@
+import bisect
+import contextlib
+import threading
+import time
+
+# Seconds, from a quick GPIO or I2C transfer up to a network timeout
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs]
+    return '{' + ','.join('%s="%s"' % pair for pair in escaped) + '}'
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type)]
+        lines.extend(self._samples())
+        return lines
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super(Counter, self).__init__(name, help, labels)
+        self.__values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.__values[key] = self.__values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = list(self.__values.items())
+        return ['%s%s %s' % (self.name, format_labels(self.labels, key), format_value(value)) for key, value in values]
+
+class Gauge(Metric):
+    '''
+    A value that goes up and down. Set it directly, or give a callback that
+    returns {label values tuple: value} and is called at render time.
+    '''
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=(), callback=None):
+        super(Gauge, self).__init__(name, help, labels)
+        self.__values = {}
+        self.__callback = callback
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.__values[key] = value
+
+    def _samples(self):
+        if self.__callback is not None:
+            values = list(self.__callback().items())
+        else:
+            with self._lock:
+                values = list(self.__values.items())
+        return ['%s%s %s' % (self.name, format_labels(self.labels, key), format_value(value)) for key, value in values]
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: a count per bucket (plus +Inf), the sum and the count
+        self.__values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self.__values.get(key)
+            if counts is None:
+                counts = self.__values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            counts[0][index] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def _samples(self):
+        with self._lock:
+            values = [(key, list(counts[0]), counts[1], counts[2]) for key, counts in self.__values.items()]
+
+        lines = []
+        for key, buckets, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), buckets):
+                cumulative += bucket_count
+                lines.append('%s_bucket%s %d' % (self.name, format_labels(self.labels, key, ('le', format_value(float(bound)))), cumulative))
+            lines.append('%s_sum%s %s' % (self.name, format_labels(self.labels, key), format_value(total)))
+            lines.append('%s_count%s %d' % (self.name, format_labels(self.labels, key), count))
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.__metrics = {}
+        self.__lock = threading.Lock()
+
+    def register(self, metric):
+        '''
+        Add a metric, or get the one already registered under its name
+        '''
+        with self.__lock:
+            return self.__metrics.setdefault(metric.name, metric)
+
+    def unregister(self, name):
+        with self.__lock:
+            self.__metrics.pop(name, None)
+
+    def render(self):
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+def counter(name, help, labels=()):
+    return REGISTRY.register(Counter(name, help, labels))
+
+def gauge(name, help, labels=(), callback=None):
+    return REGISTRY.register(Gauge(name, help, labels, callback))
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labels, buckets))
@@ -0,0 +1,145 @@
+import collections
+import http.client
+import logging
+import threading
+import time
+import urllib.parse
+
+import metrics
+
+SEND_SECONDS = metrics.histogram('tank_notify_send_seconds', 'Time taken to send a SmartThings NOTIFY')
+SEND_ERRORS = metrics.counter('tank_notify_errors_total', 'SmartThings NOTIFYs that failed')
+SUPERSEDED = metrics.counter('tank_notify_superseded_total', 'Pending NOTIFYs replaced by a newer update')
+
+
+class NotifyDispatcher:
+    '''
+    Sends SmartThings NOTIFY requests from a background thread.
+
+    Only the latest pending body is kept for each device path; a newer update
+    replaces one that hasn't gone out yet. Requests go over a single keep-alive
+    connection that is reopened when it fails.
+    '''
+    def __init__(self, url='', timeout=15, logger=None):
+        self.timeout = timeout
+        self.sent = 0
+        self.superseded = 0
+        self.errors = 0
+        self.last_latency = 0.0
+        self.total_latency = 0.0
+        self.__url = None
+        self.__connection = None
+        self.__pending = collections.OrderedDict()
+        self.__condition = threading.Condition()
+        self.__logger = logger or logging.getLogger(__name__)
+        self.__thread = None
+        self.set_url(url)
+
+    def set_url(self, url):
+        with self.__condition:
+            if url != self.__url:
+                self.__url = url
+                # Reconnect on the next send
+                self.__target = urllib.parse.urlsplit(url) if url else None
+                self.__reconnect = True
+
+    def submit(self, device_path, body):
+        '''
+        Queue body for device_path, replacing anything still pending for it
+        '''
+        with self.__condition:
+            if device_path in self.__pending:
+                del self.__pending[device_path]
+                self.superseded += 1
+                SUPERSEDED.inc()
+            self.__pending[device_path] = body
+            self.__condition.notify()
+
+        if self.__thread is None:
+            self.start()
+
+    def depth(self):
+        with self.__condition:
+            return len(self.__pending)
+
+    def stats(self):
+        with self.__condition:
+            return {
+                'queue_depth': len(self.__pending),
+                'sent': self.sent,
+                'superseded': self.superseded,
+                'errors': self.errors,
+                'last_latency': self.last_latency,
+                'average_latency': self.total_latency / self.sent if self.sent else 0.0,
+            }
+
+    def start(self):
+        with self.__condition:
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, name='notify', daemon=True)
+                self.__thread.start()
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while not self.__pending:
+                    self.__condition.wait()
+                device_path, body = self.__pending.popitem(last=False)
+                target = self.__target
+                if self.__reconnect:
+                    self.__close()
+                    self.__reconnect = False
+
+            if target is None:
+                # Nobody subscribed yet
+                continue
+
+            started = time.monotonic()
+            try:
+                self.__send(target, device_path, body)
+            except Exception as e:
+                self.__close()
+                with self.__condition:
+                    self.errors += 1
+                SEND_ERRORS.inc()
+                self.__logger.warning('NOTIFY for %s failed: %s' % (device_path, e))
+                continue
+
+            latency = time.monotonic() - started
+            SEND_SECONDS.observe(latency)
+            with self.__condition:
+                self.sent += 1
+                self.last_latency = latency
+                self.total_latency += latency
+
+    def __send(self, target, device_path, body):
+        headers = {
+            'Content-Type': 'application/json',
+            'Content-Length': str(len(body)),
+            'Device': device_path,
+            'Connection': 'keep-alive',
+        }
+        path = target.path or '/'
+        if target.query:
+            path += '?' + target.query
+
+        # A kept-alive connection may have been dropped by the hub, try once more on a new one
+        for attempt in range(2):
+            if self.__connection is None:
+                self.__connection = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=self.timeout)
+            try:
+                self.__connection.request('NOTIFY', path, body=body, headers=headers)
+                response = self.__connection.getresponse()
+                response.read()
+                if response.will_close:
+                    self.__close()
+                return response.status
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                self.__close()
+                if attempt:
+                    raise
+
+    def __close(self):
+        if self.__connection is not None:
+            self.__connection.close()
+            self.__connection = None
@@ -0,0 +1,54 @@
+import logging
+
+from collections import OrderedDict, namedtuple
+from types import MappingProxyType
+
+import hardware
+
+
+class Reading(namedtuple('Reading', ['timestamp', 'values'])):
+    '''
+    Every quantity acquired in one tick. values is a read-only mapping of source name to value.
+    '''
+    __slots__ = ()
+
+    def get(self, name, default=None):
+        return self.values.get(name, default)
+
+class Pipeline:
+    '''
+    Acquires each source once per tick and hands the same Reading to every sink
+    '''
+    def __init__(self, logger=None):
+        self.__sources = OrderedDict()
+        self.__sinks = []
+        self.__logger = logger or logging.getLogger(__name__)
+
+    def add_source(self, name, read):
+        '''
+        Sources are read in the order they were added, so later sources can rely on earlier ones
+        '''
+        self.__sources[name] = read
+
+    def add_sink(self, sink):
+        self.__sinks.append(sink)
+
+    def acquire(self):
+        values = {}
+        for name, read in self.__sources.items():
+            try:
+                values[name] = read()
+            except Exception:
+                self.__logger.exception('Failed to read ' + name)
+                values[name] = None
+        return Reading(hardware.clock.time(), MappingProxyType(values))
+
+    def tick(self):
+        reading = self.acquire()
+        # One bad sink shouldn't keep the reading from the others
+        for sink in self.__sinks:
+            try:
+                sink(reading)
+            except Exception:
+                self.__logger.exception('Sink failed')
+        return reading
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+'''
+Replay a recorded hardware trace against the tank control logic on a virtual clock.
+
+Record a trace on the Pi by adding this to /etc/tank_monitor.conf:
+
+    [hardware]
+    record = /var/lib/tank_monitor/trace.jsonl
+
+then replay it anywhere with:
+
+    ./replay.py trace.jsonl --call 600:change_water:120
+
+Every actuator output the control logic made is printed with its time
+offset from the start of the trace. With --expect the outputs are checked
+against ones saved earlier with --output, and it exits with status 1 if
+they differ. The arguments can be kept in a file, one per line, and passed
+as @file. traces/ has scenarios checked this way, run them from the top
+of the tree with:
+
+    ./replay.py @traces/water_change.args
+
+water_change is a water change with both valves opened again partway
+through, a top off and then a top off that times out.
+'''
+
+import argparse
+import configparser
+import json
+import os
+import sys
+import tempfile
+import time
+
+import hardware
+
+
+def parse_call(value):
+    # offset:function[:argument]
+    parts = value.split(':')
+    if len(parts) < 2:
+        raise argparse.ArgumentTypeError('expected offset:function[:argument]')
+    offset = float(parts[0])
+    return offset, parts[1], parts[2:]
+
+def parse_request(value):
+    # offset:METHOD:path[:json body]
+    parts = value.split(':', 3)
+    if len(parts) < 3:
+        raise argparse.ArgumentTypeError('expected offset:METHOD:path[:json]')
+    body = None
+    if len(parts) > 3:
+        try:
+            body = json.loads(parts[3])
+        except ValueError as e:
+            raise argparse.ArgumentTypeError('bad JSON body: %s' % e)
+    return float(parts[0]), parts[1].upper(), parts[2], body
+
+def check(outputs, path):
+    '''
+    Print how outputs differ from the ones saved in path, returns True if they don't
+    '''
+    with open(path, 'r') as f:
+        expected = [json.loads(line) for line in f if line.strip()]
+    actual = [json.loads(json.dumps({ 'offset': round(offset, 3), 'kind': kind, 'key': key, 'value': value }))
+        for offset, kind, key, value in outputs]
+    for line in expected:
+        line['offset'] = round(line['offset'], 3)
+
+    matched = True
+    for i in range(max(len(expected), len(actual))):
+        want = expected[i] if i < len(expected) else None
+        got = actual[i] if i < len(actual) else None
+        if want != got:
+            print('output %d: expected %s, got %s' % (i, want, got), file=sys.stderr)
+            matched = False
+    return matched
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a hardware trace against tank_monitor', fromfile_prefix_chars='@')
+    parser.add_argument('trace', help='trace recorded with [hardware] record')
+    parser.add_argument('--config', help='tank_monitor config to use, defaults to an empty one')
+    parser.add_argument('--until', type=float, help='seconds of the trace to replay, defaults to all of it')
+    parser.add_argument('--call', type=parse_call, action='append', default=[],
+        help='call a tank_monitor function at an offset into the trace, as offset:function[:argument]')
+    parser.add_argument('--request', type=parse_request, action='append', default=[],
+        help='make an HTTP request to the app at an offset into the trace, as offset:METHOD:path[:json]')
+    parser.add_argument('--kind', action='append', default=[],
+        help='only print, save and check outputs of this kind (gpio_out, i2c_write), can be repeated')
+    parser.add_argument('--output', help='write the actuator outputs here as JSON lines')
+    parser.add_argument('--expect', help='outputs saved with --output that this replay has to match')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='tank_replay_')
+    config_path = args.config
+    if config_path is None:
+        # Keep the replay's state out of the real system's paths
+        config = configparser.ConfigParser()
+        config['history'] = { 'path': os.path.join(workdir, 'history.dat') }
+        config['state'] = { 'path': os.path.join(workdir, 'state.json') }
+        config['events'] = { 'journal_path': os.path.join(workdir, 'events') }
+        config_path = os.path.join(workdir, 'tank_monitor.conf')
+        with open(config_path, 'w') as f:
+            config.write(f)
+    os.environ['TANK_MONITOR_CONF'] = config_path
+
+    backend = hardware.configure('replay', args.trace)
+    clock = hardware.clock
+    start = clock.time()
+    end = backend.trace.end if args.until is None else start + args.until
+
+    # Devices and jobs are set up on import, on the replay backend
+    import tank_monitor
+
+    for offset, name, call_args in args.call:
+        clock.call_at(start + offset, getattr(tank_monitor, name), *call_args)
+
+    client = tank_monitor.app.test_client()
+    def request(method, path, body):
+        response = client.open(path, method=method, json=body)
+        print('%10.3f %-10s %-8s %d' % (clock.time() - start, 'request', method + ' ' + path, response.status_code), file=sys.stderr)
+    for offset, method, path, body in args.request:
+        clock.call_at(start + offset, request, method, path, body)
+
+    started = time.monotonic()
+    tank_monitor.scheduler.start()
+    clock.run_until(end)
+    tank_monitor.scheduler.shutdown()
+    tank_monitor.state_store.close()
+    tank_monitor.event_journal.close()
+    elapsed = time.monotonic() - started
+
+    outputs = [(when - start, kind, key, value) for when, kind, key, value in backend.outputs
+        if not args.kind or kind in args.kind]
+    for offset, kind, key, value in outputs:
+        print('%10.3f %-10s %-8s %s' % (offset, kind, key, value))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            for offset, kind, key, value in outputs:
+                f.write(json.dumps({ 'offset': offset, 'kind': kind, 'key': key, 'value': value }) + '\n')
+
+    print('Replayed %.0f seconds in %.2f seconds' % (end - start, elapsed), file=sys.stderr)
+
+    if args.expect and not check(outputs, args.expect):
+        print('Outputs differ from ' + args.expect, file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
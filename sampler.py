@@ -0,0 +1,94 @@
+import threading
+
+from collections import namedtuple
+from datetime import timedelta
+
+import hardware
+
+
+class Sample(namedtuple('Sample', ['value', 'timestamp'])):
+    '''
+    A single reading taken from a sensor, along with the time it was taken
+    '''
+    __slots__ = ()
+
+    def age(self):
+        return hardware.clock.time() - self.timestamp
+
+class Sampler:
+    '''
+    Reads a sensor on its own schedule and keeps the latest reading as a snapshot
+    so callers don't have to wait on the hardware.
+
+    on_change(sample) is called whenever a sample's value differs from the previous one.
+    The first read is delayed by offset seconds, see stagger().
+    '''
+    def __init__(self, name, read, interval, max_age=None, on_change=None):
+        self.name = name
+        self.interval = interval
+        self.offset = 0
+        self.max_age = max_age if max_age is not None else interval * 2
+        self.__read = read
+        self.__on_change = on_change
+        self.__latest = None
+        self.__lock = threading.Lock()
+        # Held while talking to the hardware, so only one thread reads at a time
+        self.__read_lock = threading.Lock()
+
+    def latest(self):
+        with self.__lock:
+            return self.__latest
+
+    def sample(self):
+        '''
+        Read the sensor now and update the snapshot
+        '''
+        with self.__read_lock:
+            return self.__sample()
+
+    def __sample(self):
+        return self.update(self.__read())
+
+    def update(self, value, timestamp=None):
+        '''
+        Store a reading that was taken some other way, like one streamed from the sensor
+        '''
+        sample = Sample(value, hardware.clock.time() if timestamp is None else timestamp)
+        with self.__lock:
+            previous = self.__latest
+            self.__latest = sample
+        if self.__on_change is not None and (previous is None or previous.value != value):
+            self.__on_change(sample)
+        return sample
+
+    def get(self, fresh=False, max_age=None):
+        '''
+        Get the snapshot, reading the sensor if it is too old or a fresh value was requested
+        '''
+        if max_age is None:
+            max_age = self.max_age
+
+        sample = self.latest()
+        if fresh or sample is None or sample.age() > max_age:
+            started = hardware.clock.time()
+            with self.__read_lock:
+                # Another thread may have just finished a read while we waited
+                sample = self.latest()
+                if sample is None or sample.timestamp < started:
+                    sample = self.__sample()
+        return sample
+
+    def schedule(self, scheduler):
+        start = hardware.clock.now() + timedelta(seconds=self.interval + self.offset)
+        scheduler.add_job(self.sample, 'interval', seconds=self.interval, start_date=start, id='sample_' + self.name)
+
+def stagger(samplers):
+    '''
+    Spread the reads of samplers that share a bus evenly across the shortest
+    of their intervals, so they take turns on the bus instead of all waking at once
+    '''
+    if not samplers:
+        return
+    slot = min(sampler.interval for sampler in samplers) / len(samplers)
+    for index, sampler in enumerate(samplers):
+        sampler.offset = index * slot
@@ -0,0 +1,96 @@
+import contextlib
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+
+class Busy(Exception):
+    '''
+    Raised when a hardware resource stays in use for longer than we are willing to wait
+    '''
+    pass
+
+class ResourceLimiter:
+    '''
+    Caps how many requests can use each piece of hardware at once, so a slow
+    sensor only holds up requests for that sensor
+    '''
+    def __init__(self, limits, timeout):
+        self.timeout = timeout
+        self.__semaphores = {name: threading.BoundedSemaphore(limit) for name, limit in limits.items()}
+
+    @contextlib.contextmanager
+    def hold(self, name):
+        semaphore = self.__semaphores.get(name)
+        if semaphore is None:
+            yield
+            return
+
+        if not semaphore.acquire(timeout=self.timeout):
+            raise Busy(name)
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+# Sent straight down the socket when there is no room to queue a connection
+BUSY_RESPONSE = (b'HTTP/1.1 503 Service Unavailable\r\nContent-Type: text/plain\r\n'
+    b'Content-Length: 12\r\nRetry-After: 1\r\nConnection: close\r\n\r\nServer busy\n')
+
+class PooledWSGIServer(BaseWSGIServer):
+    '''
+    WSGI server that handles connections on a fixed pool of worker threads,
+    with a socket timeout on every request. At most max_queue connections
+    wait for a free thread, any more are answered with a 503 straight away.
+    '''
+    multithread = True
+
+    def __init__(self, host, port, app, threads, request_timeout, max_queue=None):
+        handler = type('TimeoutRequestHandler', (WSGIRequestHandler,), { 'timeout': request_timeout })
+        super(PooledWSGIServer, self).__init__(host, port, app, handler=handler)
+        self.max_queue = threads if max_queue is None else max_queue
+        self.__pool = ThreadPoolExecutor(threads, thread_name_prefix='http')
+        # One per connection that is running or waiting for a thread
+        self.__slots = threading.BoundedSemaphore(threads + self.max_queue)
+
+    def process_request(self, request, client_address):
+        if not self.__slots.acquire(blocking=False):
+            self.__reject(request)
+            return
+        self.__pool.submit(self.__process_request, request, client_address)
+
+    def __process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.__slots.release()
+
+    def __reject(self, request):
+        try:
+            request.settimeout(1)
+            request.sendall(BUSY_RESPONSE)
+        except OSError:
+            pass
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super(PooledWSGIServer, self).server_close()
+        self.__pool.shutdown(wait=False)
+
+def serve(app, host, port, threads, request_timeout, ready=None, max_queue=None):
+    '''
+    Serve app until interrupted, ready() is called once we are listening
+    '''
+    server = PooledWSGIServer(host, port, app, threads, request_timeout, max_queue)
+    if ready is not None:
+        ready()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,40 @@
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+
+import metrics
+
+PHASE_SECONDS = metrics.gauge('tank_startup_phase_seconds', 'How long each phase of startup took', ('phase',))
+
+
+class Startup:
+    '''
+    Times the phases of startup.
+
+    mark(phase) ends a phase that ran from the end of the previous one,
+    record(phase, seconds) adds one that ran in the background alongside them.
+    '''
+    def __init__(self, started=None, logger=None):
+        self.started = time.monotonic() if started is None else started
+        self.phases = OrderedDict()
+        self.__last = self.started
+        self.__lock = threading.Lock()
+        self.__logger = logger or logging.getLogger(__name__)
+
+    def mark(self, phase):
+        now = time.monotonic()
+        with self.__lock:
+            seconds = now - self.__last
+            self.__last = now
+        self.record(phase, seconds)
+
+    def record(self, phase, seconds):
+        with self.__lock:
+            self.phases[phase] = seconds
+        PHASE_SECONDS.set(seconds, phase=phase)
+        self.__logger.info('Startup: %s took %.3f seconds' % (phase, seconds))
+
+    def elapsed(self):
+        return time.monotonic() - self.started
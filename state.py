@@ -0,0 +1,173 @@
+import json
+import logging
+import os
+import threading
+
+# Marks a key that was deleted but not written out yet
+DELETED = object()
+
+
+class StateStore:
+    '''
+    Controller state that has to survive a restart, kept as a JSON snapshot
+    plus a journal of the changes made since the snapshot was written.
+
+    set() only updates memory. A background thread waits flush_interval
+    seconds after the first change so a burst of changes piles up, then
+    appends the latest value of every changed key to the journal with a
+    single fsync. Once the journal holds compact_after entries the whole
+    state is written to a new snapshot, fsynced and renamed over the old one,
+    and the journal is started over.
+
+    A journal line cut short by a power cut is ignored when loading.
+    '''
+    def __init__(self, path, flush_interval=5, compact_after=500, logger=None):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.flush_interval = flush_interval
+        self.compact_after = compact_after
+        self.__state = {}
+        self.__dirty = {}
+        self.__journal_entries = 0
+        self.__closed = False
+        self.__thread = None
+        self.__condition = threading.Condition()
+        # Held while writing either file, so a compaction can't drop a journal append
+        self.__write_lock = threading.Lock()
+        self.__logger = logger or logging.getLogger(__name__)
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def load(self):
+        state = {}
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            self.__logger.warning('Ignoring unreadable state snapshot %s' % self.path)
+
+        entries = 0
+        try:
+            with open(self.journal_path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Cut short while being written, nothing after it made it to disk
+                        break
+                    if 'value' in entry:
+                        state[entry['key']] = entry['value']
+                    else:
+                        state.pop(entry['key'], None)
+                    entries += 1
+        except FileNotFoundError:
+            pass
+
+        with self.__condition:
+            self.__state = state
+            self.__journal_entries = entries
+
+        if entries:
+            # Start from a clean journal, anything appended after a torn line would be lost
+            with self.__write_lock:
+                self.__compact()
+
+    def get(self, key, default=None):
+        with self.__condition:
+            return self.__state.get(key, default)
+
+    def set(self, key, value):
+        with self.__condition:
+            if key in self.__state and self.__state[key] == value:
+                return
+            self.__state[key] = value
+            self.__changed(key, value)
+
+    def delete(self, key):
+        with self.__condition:
+            if key not in self.__state:
+                return
+            del self.__state[key]
+            self.__changed(key, DELETED)
+
+    def __changed(self, key, value):
+        # Only the first change of a batch wakes the writer, later ones just wait for it
+        if not self.__dirty:
+            self.__condition.notify()
+        self.__dirty[key] = value
+
+        if self.__thread is None and not self.__closed:
+            self.__thread = threading.Thread(target=self.__run, name='state', daemon=True)
+            self.__thread.start()
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while not self.__dirty and not self.__closed:
+                    self.__condition.wait()
+                if not self.__closed:
+                    self.__condition.wait(self.flush_interval)
+                closed = self.__closed
+
+            self.flush()
+            if closed:
+                return
+
+    def flush(self):
+        '''
+        Write out any pending changes now
+        '''
+        with self.__write_lock:
+            with self.__condition:
+                dirty, self.__dirty = self.__dirty, {}
+            if dirty:
+                lines = []
+                for key, value in dirty.items():
+                    entry = { 'key': key } if value is DELETED else { 'key': key, 'value': value }
+                    lines.append(json.dumps(entry) + '\n')
+                try:
+                    with open(self.journal_path, 'a') as f:
+                        f.write(''.join(lines))
+                        f.flush()
+                        os.fsync(f.fileno())
+                except (IOError, OSError) as e:
+                    self.__logger.warning('Failed to write state journal: %s' % e)
+                    with self.__condition:
+                        # Try again with the next batch, unless there is a newer value by then
+                        for key, value in dirty.items():
+                            self.__dirty.setdefault(key, value)
+                    return
+                self.__journal_entries += len(dirty)
+
+            if self.__journal_entries >= self.compact_after:
+                self.__compact()
+
+    def __compact(self):
+        with self.__condition:
+            snapshot = json.dumps(self.__state, sort_keys=True)
+
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(snapshot)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            # The journal is only emptied once the snapshot that replaces it is safely on disk
+            with open(self.journal_path, 'w') as f:
+                os.fsync(f.fileno())
+        except (IOError, OSError) as e:
+            self.__logger.warning('Failed to write state snapshot: %s' % e)
+            return
+        self.__journal_entries = 0
+
+    def close(self):
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify()
+        self.flush()
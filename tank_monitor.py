@@ -1,61 +1,282 @@
 #!/usr/bin/env python3
 
+# First, so the startup timings include our imports
+import time
+startup_started = time.monotonic()
+
 from flask import Flask
 from flask import make_response
 from flask import request
+from flask import Response
 
 from flask_restful import Api, Resource, reqparse
 
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.jobstores.base import JobLookupError
 from AtlasI2C import AtlasI2C
-from w1thermsensor import W1ThermSensor
-from datetime import datetime
+from sampler import Sample, Sampler, stagger
+from filters import RollingMedian
+from pipeline import Pipeline
+from history import HistoryStore
+from thingspeak import ThingSpeakUploader
+from notify import NotifyDispatcher
+from events import EventBus
+from jobs import JobMonitor, SAFETY
+from startup import Startup
+from concurrent.futures import ThreadPoolExecutor
+from alerts import AlertDispatcher, SendmailTransport, SMTPTransport, WebhookTransport
+from anomaly import AnomalyDetector, Rule, check_rules
+from state import StateStore
+from journal import EventJournal, EVENT_TYPES
+from discovery import DeviceRegistry
+from server import Busy, ResourceLimiter
+import server
+import hardware
+import metrics
+from datetime import datetime, timedelta
 
 import configparser
-import RPi.GPIO as GPIO
-import urllib.request
 import json
-import numpy
 import os
+import sys
 import logging
+import threading
+import itertools
+import hashlib
+import signal
 
-config_path = '/etc/tank_monitor.conf'
+config_path = os.environ.get('TANK_MONITOR_CONF', '/etc/tank_monitor.conf')
 
 # Parse configuration
 config = configparser.ConfigParser()
 config.read(config_path)
 
+# logging config
+# Everything goes through the app's logger, messages below level are dropped
+log_level = config.get('logging', 'level', fallback='INFO').strip().upper()
+
 # thingspeak config
-thingspeak_base_url = ''
+thingspeak_api_key = ''
 if config.has_option('thingspeak', 'api_key'):
     thingspeak_api_key = config.get('thingspeak', 'api_key').strip()
-    if thingspeak_api_key:
-        thingspeak_base_url = 'https://api.thingspeak.com/update?api_key=%s' % thingspeak_api_key
+# With a channel_id points are uploaded in batches through the bulk update API
+thingspeak_channel_id = config.get('thingspeak', 'channel_id', fallback='').strip()
+thingspeak_url = config.get('thingspeak', 'url', fallback='https://api.thingspeak.com')
+thingspeak_queue_path = config.get('thingspeak', 'queue_path', fallback='/var/lib/tank_monitor/thingspeak_queue.jsonl')
+thingspeak_batch_size = config.getint('thingspeak', 'batch_size', fallback=100)
 
 # smartthings config
 smartthings_notify_url = ''
 if config.has_option('smartthings', 'notify_url'):
     smartthings_notify_url = config.get('smartthings', 'notify_url')
 
+# hardware config
+# Set record to a file to append a trace of every hardware input and output,
+# the trace can be replayed against the control logic with replay.py
+hardware_record = config.get('hardware', 'record', fallback='')
+if hardware_record and isinstance(hardware.backend, hardware.RealBackend):
+    hardware.configure('record', hardware_record)
+GPIO = hardware.backend.gpio
+
+# sampler config
+# Sensors are read in the background; requests are served from the latest
+# reading as long as it is no older than max_age seconds. The intervals are
+# defaults, each tank can override them in its own section
+sampler_max_age = config.getfloat('sampler', 'max_age', fallback=120)
+temperature_interval = config.getfloat('sampler', 'temperature_interval', fallback=10)
+ph_interval = config.getfloat('sampler', 'ph_interval', fallback=60)
+water_level_interval = config.getfloat('sampler', 'water_level_interval', fallback=10)
+
+# temperature config
+# Each sampler tick takes one conversion, the reported value is the median of the last few
+temperature_resolution = config.getint('temperature', 'resolution', fallback=None)
+temperature_window = config.getint('temperature', 'window', fallback=5)
+temperature_max_deviation = config.getfloat('temperature', 'max_deviation', fallback=None)
+
+# pH config
+# With stream on, each board is read back to back in the background, about once a
+# second, and the sampler hands out the latest of those readings instead of asking
+# for one. Temperature compensation is then only sent to the board when the
+# temperature has moved by more than compensation_threshold degrees. A tank can
+# turn it on or off with ph_stream in its own section
+ph_stream = config.getboolean('ph', 'stream', fallback=False)
+ph_compensation_threshold = config.getfloat('ph', 'compensation_threshold', fallback=0.1)
+
+# history config
+# One record is stored per pipeline tick (every minute)
+history_path = config.get('history', 'path', fallback='/var/lib/tank_monitor/history.dat')
+history_retention_days = config.getfloat('history', 'retention_days', fallback=30)
+
+# i2c config
+# Buses to look for devices on, and where to remember what was found
+i2c_buses = [int(bus) for bus in config.get('i2c', 'buses', fallback='1').split(',') if bus.strip()]
+i2c_registry_path = config.get('i2c', 'registry_path', fallback='/var/lib/tank_monitor/i2c_devices.json')
+
+# water level config
+# Edges from the float switch are acted on once it has been quiet for debounce seconds,
+# the fill valve is also checked every watchdog_interval seconds in case an edge is missed
+water_level_debounce = config.getfloat('water_level', 'debounce', fallback=0.05)
+water_level_watchdog_interval = config.getfloat('water_level', 'watchdog_interval', fallback=3)
+
+# tank config
+# Each tank is declared in a [tank:<name>] section, for example
+#
+#   [tank:reef]
+#   drain_gpio = 6
+#   fill_gpio = 13
+#   day_light_gpio = 19
+#   night_light_gpio = 26
+#   water_level_gpio = 21
+#   temperature_serial = 0316a2794aff
+#   ph_address = 100
+#
+# Anything left out takes the original single tank's value. Without any
+# sections there is one tank called "tank" wired up as it always has been.
+tank_names = [section[len('tank:'):] for section in config.sections() if section.startswith('tank:')] or ['tank']
+# The original tank's wiring
+tank_defaults = {
+    'drain_gpio': 17,
+    'fill_gpio': 27,
+    'day_light_gpio': 23,
+    'night_light_gpio': 25,
+    'water_level_gpio': 5,
+    'temperature_serial': '02099177ba76',
+    'ph_address': 99,
+}
+# Pins that drive relays, they are all switched off before anything else happens
+tank_outputs = ('drain_gpio', 'fill_gpio', 'day_light_gpio', 'night_light_gpio')
+
 app = Flask(__name__)
+# Set here rather than in main() so the startup phases below are logged too
+app.logger.setLevel(log_level)
 api = Api(app)
-GPIO.setmode(GPIO.BCM)
+startup = Startup(startup_started, app.logger)
+startup.mark('imports')
 
-def mail(subject, message):
-    FROM="SmartThings@FishTank"
-    TO="root"
-    message = """\
-From: %s
-To: %s
-Subject: %s
-
-%s
-""" % (FROM, TO, subject, message)
-    p = os.popen("/usr/sbin/sendmail -t -i", "w")
-    p.write(message)
-    status = p.close()
-    if status != 0:
-        print("Sendmail exit status" + str(status))
+# Make sure every valve and light is off before anything else, the state store
+# and event journal below may spend a while on the SD card
+GPIO.setmode(GPIO.BCM)
+for name in tank_names:
+    for output in tank_outputs:
+        pin = config.getint('tank:' + name, output, fallback=tank_defaults[output])
+        GPIO.setup(pin, GPIO.OUT)
+        GPIO.output(pin, GPIO.LOW)
+startup.mark('safe_outputs')
+
+# anomaly config
+# Rules checked against every reading are declared in [anomaly:<name>] sections, for example
+#
+#   [anomaly:heater]
+#   field = temperature
+#   type = band
+#   low = 24
+#   high = 28
+#   window = 1800
+#
+# sends an alert once the temperature has been outside 24-28C for half an
+# hour. type is one of rate, zscore, band or flatline, see anomaly.Rule.
+# tank picks the tank a rule is for (the first one by default) and
+# min_samples how many readings it needs before it can fire.
+anomaly_capacity = config.getint('anomaly', 'capacity', fallback=24 * 60)
+anomaly_rules = {}
+for section in config.sections():
+    if section.startswith('anomaly:'):
+        anomaly_rules.setdefault(config.get(section, 'tank', fallback=tank_names[0]), []).append(Rule(
+            name=section[len('anomaly:'):],
+            field=config.get(section, 'field'),
+            type=config.get(section, 'type'),
+            window=config.getfloat(section, 'window', fallback=60 * 60),
+            threshold=config.getfloat(section, 'threshold', fallback=None),
+            low=config.getfloat(section, 'low', fallback=None),
+            high=config.getfloat(section, 'high', fallback=None),
+            min_samples=config.getint(section, 'min_samples', fallback=3),
+        ))
+
+# events config
+# Each /events client buffers at most this many events, dropping the oldest when full
+events_buffer = config.getint('events', 'buffer', fallback=100)
+events_heartbeat = config.getfloat('events', 'heartbeat', fallback=15)
+
+# scheduler config
+# Jobs that drive the valves run in their own pool of safety_threads, so a slow
+# sensor read or upload in the default pool can't hold them up. If a safety job
+# starts more than safety_deadline seconds late every valve is closed
+scheduler_threads = config.getint('scheduler', 'threads', fallback=10)
+scheduler_safety_threads = config.getint('scheduler', 'safety_threads', fallback=4)
+safety_deadline = config.getfloat('scheduler', 'safety_deadline', fallback=10)
+telemetry_deadline = config.getfloat('scheduler', 'telemetry_deadline', fallback=60)
+
+# alerts config
+# transports is a comma separated list of sendmail, smtp and webhook, every alert goes to each.
+# An alert is suppressed if one with the same cause went out less than dedup_interval
+# seconds ago, and alerts arriving within digest_delay seconds are sent as one digest
+alerts_transports = [t.strip() for t in config.get('alerts', 'transports', fallback='sendmail').split(',') if t.strip()]
+alerts_from = config.get('alerts', 'from', fallback='SmartThings@FishTank')
+alerts_to = config.get('alerts', 'to', fallback='root')
+alerts_sendmail_path = config.get('alerts', 'sendmail_path', fallback='/usr/sbin/sendmail')
+alerts_smtp_host = config.get('alerts', 'smtp_host', fallback='localhost')
+alerts_smtp_port = config.getint('alerts', 'smtp_port', fallback=25)
+alerts_webhook_url = config.get('alerts', 'webhook_url', fallback='')
+alerts_queue = config.getint('alerts', 'queue', fallback=100)
+alerts_dedup_interval = config.getfloat('alerts', 'dedup_interval', fallback=60 * 60)
+alerts_digest_delay = config.getfloat('alerts', 'digest_delay', fallback=30)
+
+# state config
+# Controller state is kept here so it survives a restart, changes are written
+# out at most every flush_interval seconds to spare the SD card
+state_path = config.get('state', 'path', fallback='/var/lib/tank_monitor/state.json')
+state_flush_interval = config.getfloat('state', 'flush_interval', fallback=5)
+# A water change interrupted for longer than this isn't resumed, the tank is just filled back up
+water_change_resume_window = config.getfloat('state', 'water_change_resume_window', fallback=60 * 60)
+
+# event journal config
+# Every valve, light and float switch change is appended to a binary journal
+# in this directory, for /events/log. It is kept in segments of segment_size
+# bytes, the oldest are deleted once there are more than max_segments
+events_journal_path = config.get('events', 'journal_path', fallback='/var/lib/tank_monitor/events')
+events_segment_size = config.getint('events', 'segment_size', fallback=256 * 1024)
+events_max_segments = config.getint('events', 'max_segments', fallback=64)
+
+# server config
+server_host = config.get('server', 'host', fallback='0.0.0.0')
+server_port = config.getint('server', 'port', fallback=5000)
+server_threads = config.getint('server', 'threads', fallback=16)
+server_request_timeout = config.getfloat('server', 'request_timeout', fallback=30)
+# Connections waiting for a free thread, past this they get a 503
+server_queue = config.getint('server', 'queue', fallback=server_threads)
+# Each /events client holds a thread for as long as it is connected, so they
+# can only ever have some of them and the valves can still be reached
+events_max_subscribers = min(config.getint('events', 'max_subscribers', fallback=max(server_threads // 4, 1)),
+    server_threads - 1)
+# How many requests can use each hardware resource at once, and how long to wait for it
+hardware_limits = {
+    'i2c': config.getint('server', 'i2c_concurrency', fallback=1),
+    'onewire': config.getint('server', 'onewire_concurrency', fallback=1),
+    'gpio': config.getint('server', 'gpio_concurrency', fallback=2),
+}
+hardware_wait = config.getfloat('server', 'hardware_wait', fallback=10)
+
+# Sends NOTIFYs in the background so a slow hub can't hold up valve control
+notifier = NotifyDispatcher(smartthings_notify_url, logger=app.logger)
+
+# Everything we need to remember across a restart
+state_store = StateStore(state_path, state_flush_interval, logger=app.logger)
+# What the valves and lights did, and when
+event_journal = EventJournal(events_journal_path, events_segment_size, events_max_segments, logger=app.logger)
+
+# Streams state changes to /events clients
+event_bus = EventBus(events_buffer, events_heartbeat, events_max_subscribers)
+# Alerts go out from the background, deduplicated and batched
+alert_transports = []
+for transport in alerts_transports:
+    if transport == 'sendmail':
+        alert_transports.append(SendmailTransport(alerts_from, alerts_to, alerts_sendmail_path))
+    elif transport == 'smtp':
+        alert_transports.append(SMTPTransport(alerts_from, alerts_to, alerts_smtp_host, alerts_smtp_port))
+    elif transport == 'webhook':
+        alert_transports.append(WebhookTransport(alerts_webhook_url))
+    else:
+        raise ValueError('Unknown alert transport ' + transport)
+alert_dispatcher = AlertDispatcher(alert_transports, alerts_queue, alerts_dedup_interval, alerts_digest_delay, logger=app.logger)
 
 class Switch:
     def __init__(self, gpio):
@@ -81,38 +302,59 @@ class SmartThingsAPIDevice:
     def __init__(self, device_name, device_type):
         self.device_type = device_type
         self.device_name = device_name
-        self.__device_path = self.device_type + '/' + self.device_name
+        self.device_path = self.device_type + '/' + self.device_name
+        self.__versions = itertools.count(1)
+        self.version = 0
+
+    def changed(self, *args):
+        '''
+        Record that our state changed, so cached responses get rebuilt
+        and /events clients hear about it
+        '''
+        self.version = next(self.__versions)
+        if event_bus.has_subscribers():
+            body = self.status_body() or b'null'
+            event_bus.publish('state', '{"device": %s, "state": %s}' % (json.dumps(self.device_path), body.decode()))
 
-    def notify(self):
+    def status_body(self):
+        '''
+        Get the body for /status and /events, this never touches the hardware
+        '''
+        return self.get_body()
+
+    def notify(self, body=None):
         '''
         Push an unsolicited update to SmartThings
         '''
-        body = self.get_body()
-        headers = {
-            'Content-Type': 'application/json',
-            'Content-Length': len(body),
-            'Device': self.__device_path
-        }
+        if body is None:
+            body = self.get_body()
         if smartthings_notify_url:
-            req = urllib.request.Request(smartthings_notify_url, method='NOTIFY', headers=headers, data=body)
-            urllib.request.urlopen(req, timeout=15)
+            notifier.submit(self.device_path, body)
 
-    def get_response(self):
+    def get_response(self, **kwargs):
         '''
         Get a response for an HTTP GET or POST
         '''
-        resp = make_response(self.get_body())
-        resp.headers['Device'] = self.__device_path
+        resp = make_response(self.get_body(**kwargs))
+        resp.headers['Device'] = self.device_path
         return resp
 
 class Valve(SmartThingsAPIDevice):
-    def __init__(self, device_name, gpio, open_precheck=None, open_action=None, close_action=None):
+    def __init__(self, device_name, gpio, open_precheck=None, open_action=None, close_action=None, on_preempt=None):
         super(Valve, self).__init__(device_type='valve', device_name=device_name)
 
         self.__switch = Switch(gpio)
         self.__open_precheck = open_precheck
         self.__open_action = open_action
         self.__close_action = None
+        # Called before we are closed so another valve can open
+        self.on_preempt = on_preempt
+
+        # The relays drop out when we stop, so a valve that was open last time is closed now
+        previous = state_store.get(self.device_path)
+        if previous is not None and previous.get('state') == 'open':
+            app.logger.warn('%s was open when we stopped, opened at %s' % (
+                self.device_name, datetime.fromtimestamp(previous['opened'])))
 
         self.close()
         self.notify()
@@ -123,31 +365,47 @@ class Valve(SmartThingsAPIDevice):
     def open_duration(self):
         if self.__open_time == 0:
             return 0
-        return (datetime.now() - self.__open_time).total_seconds()
+        return (hardware.clock.now() - self.__open_time).total_seconds()
 
     def close(self):
+        was_open = self.is_open()
+        if was_open:
+            event_journal.record('valve_close', self.device_path, { 'seconds': round(self.open_duration(), 3) })
         self.__switch.off()
         self.state = 'closed'
         self.__open_time = 0
-        if self.__close_action is not None:
+        state_store.set(self.device_path, { 'state': self.state })
+        self.changed()
+        # Only undo the open action if we actually were open
+        if was_open and self.__close_action is not None:
             self.__close_action()
 
     def open(self):
+        # Already open, keep the timers we started when it opened
+        if self.is_open():
+            return
+
         # Only one valve can ever be open so we don't blow a fuse
         # Close any other open valves
-        for k, k_valve in valves.items():
-            if k is not self and k_valve.is_open():
+        for k_valve in valves.values():
+            if k_valve is not self and k_valve.is_open():
                 app.logger.info('Closing ' + k_valve.device_name + ' to open ' + self.device_name)
+                if k_valve.on_preempt is not None:
+                    k_valve.on_preempt(k_valve, self)
                 k_valve.close()
                 k_valve.notify()
 
         if self.__open_precheck is not None and not self.__open_precheck():
             app.logger.info('Refusing to open ' + self.device_name + ' due to precheck')
+            event_journal.record('valve_refused', self.device_path)
             return
 
         self.__switch.on()
         self.state = 'open'
-        self.__open_time = datetime.now()
+        self.__open_time = hardware.clock.now()
+        event_journal.record('valve_open', self.device_path)
+        state_store.set(self.device_path, { 'state': self.state, 'opened': self.__open_time.timestamp() })
+        self.changed()
         if self.__open_action is not None:
             self.__open_action()
 
@@ -163,20 +421,15 @@ class Valve(SmartThingsAPIDevice):
         return body
 
 class Light(SmartThingsAPIDevice):
-    def __init__(self, device_name):
+    def __init__(self, device_name, day_gpio, night_gpio):
         super(Light, self).__init__(device_type='light', device_name=device_name)
 
-        self.__day_light = Switch(23)
-        self.__night_light = Switch(25)
+        self.__day_light = Switch(day_gpio)
+        self.__night_light = Switch(night_gpio)
         self.state = 0
-        self.__state_file = '/tmp/' + self.device_name + '_light_state.txt'
 
-        # Load the initial light state (if possible)
-        try:
-            with open(self.__state_file, 'r') as f:
-                self.set_state(int(f.read()))
-        except IOError:
-             pass
+        # Restore the last light state (if we have one)
+        self.set_state(state_store.get(self.device_path))
 
         # Send the initial state to SmartThings
         self.notify()
@@ -203,9 +456,11 @@ class Light(SmartThingsAPIDevice):
         else:
             return
 
+        if state != self.state:
+            event_journal.record('light', self.device_path, { 'state': state })
         self.state = state
-        with open(self.__state_file, 'w') as f:
-            f.write(str(self.state))
+        self.changed()
+        state_store.set(self.device_path, self.state)
 
     def get_body(self):
         '''
@@ -216,27 +471,76 @@ class Light(SmartThingsAPIDevice):
         return body
 
 class PHSensor(SmartThingsAPIDevice):
-    def __init__(self, device_name, temp_sensor):
+    # A streamed reading older than this means the stream has stalled
+    stream_max_age = 10 * AtlasI2C.long_timeout
+
+    def __init__(self, device_name, temp_sensor, address, bus, interval, stream=False):
         super(PHSensor, self).__init__(device_type='ph', device_name=device_name)
-        self.__sensor = AtlasI2C(address=99)
+        self.bus = bus
+        self.address = address
+        self.streaming = stream
+        self.__sensor = None
+        self.__init_lock = threading.Lock()
         self.__temp_sensor = temp_sensor
+        self.__streamed = None
+        self.sampler = Sampler('ph_' + device_name, self.read, interval, sampler_max_age, self.changed)
+
+    def init(self):
+        '''
+        Open the board's bus, startup does this in the background but it happens on first use if needed
+        '''
+        with self.__init_lock:
+            if self.__sensor is None:
+                self.__sensor = AtlasI2C(address=self.address, bus=self.bus)
+            return self.__sensor
 
     def read(self, tempC=None):
-        # Read the temp from our service
+        if self.streaming:
+            # The stream owns the board, writing to it now would cut into a reading
+            streamed = self.__streamed
+            if streamed is None or hardware.clock.time() - streamed.timestamp > self.stream_max_age:
+                return None
+            return streamed.value
+
+        # Use the latest temperature for compensation
         if tempC is None:
-            tempC = self.__temp_sensor.readC()
+            tempC = self.__temp_sensor.sampler.get().value
 
-        pH = self.__sensor.query('RT,' + str(tempC))
-        if pH.startswith('Command succeeded '):
-            pH = float(pH[18:].rstrip("\0"))
-            return pH
+        response = self.init().query('RT,' + str(tempC))
+        if response.ok():
+            return response.value
         return None
 
-    def get_body(self):
+    def start_stream(self):
+        if self.streaming:
+            threading.Thread(target=self.__stream, name='stream_' + self.sampler.name, daemon=True).start()
+
+    def __stream(self):
+        while True:
+            try:
+                for timestamp, response in self.init().stream(self.__temperature, ph_compensation_threshold):
+                    if response.ok() and response.value is not None:
+                        self.__streamed = Sample(response.value, timestamp)
+                        self.sampler.update(response.value, timestamp)
+            except Exception:
+                app.logger.exception('pH stream for ' + self.sampler.name + ' failed, restarting it')
+                hardware.clock.sleep(AtlasI2C.long_timeout)
+
+    def __temperature(self):
+        sample = self.__temp_sensor.sampler.latest()
+        return sample.value if sample is not None else None
+
+    def get_body(self, fresh=False):
         '''
         Get the body we send out for response/notify
         '''
-        pH = self.read()
+        return self.format_body(self.sampler.get(fresh).value)
+
+    def status_body(self):
+        sample = self.sampler.latest()
+        return self.format_body(sample.value if sample is not None else None)
+
+    def format_body(self, pH):
         if pH is not None:
             message = {
                 'pH': pH
@@ -246,34 +550,69 @@ class PHSensor(SmartThingsAPIDevice):
         return ''
 
 class TemperatureSensor(SmartThingsAPIDevice):
-    def __init__(self, device_name):
+    def __init__(self, device_name, serial, interval):
         super(TemperatureSensor, self).__init__(device_type='temperature', device_name=device_name)
-        self.__sensor = W1ThermSensor(W1ThermSensor.THERM_SENSOR_DS18B20, "02099177ba76")
+        self.__serial = serial
+        self.__sensor = None
+        self.__init_lock = threading.Lock()
+        self.__filter = RollingMedian(temperature_window, temperature_max_deviation)
+        self.__filter_lock = threading.Lock()
+        self.sampler = Sampler('temperature_' + device_name, self.convert, interval, sampler_max_age, self.changed)
+
+    def init(self):
+        '''
+        Open the sensor, startup does this in the background but it happens on first use if needed
+        '''
+        with self.__init_lock:
+            if self.__sensor is None:
+                sensor = hardware.backend.temperature_sensor(self.__serial)
+                if temperature_resolution is not None:
+                    # Lower resolutions convert faster (9 bit is ~94ms, 12 bit is ~750ms)
+                    sensor.set_resolution(temperature_resolution)
+                self.__sensor = sensor
+            return self.__sensor
 
     def celcius_to_fahrenheit(self, tempC):
         return round((9.0/5.0 * tempC + 32), 2)
 
-    def __read(self):
-        readings = []
-        for i in range(3):
-            readings.append(self.__sensor.get_temperature(W1ThermSensor.DEGREES_C))
-            readings.append(self.__sensor.get_temperature(W1ThermSensor.DEGREES_C))
-        return round(numpy.median(readings), 3)
+    def convert(self):
+        '''
+        Take a single conversion, add it to the filter and return the filtered value
+        '''
+        try:
+            reading = self.init().get_temperature()
+        except Exception:
+            onewire_reads.inc(result='error')
+            raise
+        onewire_reads.inc(result='ok')
+        with self.__filter_lock:
+            self.__filter.add(reading)
+            return round(self.__filter.value(), 3)
 
     def readC(self):
-        return self.__read()
+        with self.__filter_lock:
+            tempC = self.__filter.value()
+        if tempC is None:
+            return self.convert()
+        return round(tempC, 3)
 
     def readF(self):
         tempC = self.readC()
         tempF = self.celcius_to_fahrenheit(tempC)
         return tempF
 
-    def get_body(self):
+    def get_body(self, fresh=False):
         '''
         Get the body we send out for response/notify
         '''
-        tempC = self.readC()
-        tempF = self.celcius_to_fahrenheit(tempC)
+        return self.format_body(self.sampler.get(fresh).value)
+
+    def status_body(self):
+        sample = self.sampler.latest()
+        return self.format_body(sample.value if sample is not None else None)
+
+    def format_body(self, tempC):
+        tempF = self.celcius_to_fahrenheit(tempC) if tempC is not None else None
         message = {
             'temperatureC': tempC,
             'temperatureF': tempF,
@@ -285,172 +624,643 @@ class WaterLevelSensor(SmartThingsAPIDevice):
     '''
     Used to check if the tank is full
     '''
-    def __init__(self, device_name, gpio):
+    def __init__(self, device_name, gpio, interval):
         super(WaterLevelSensor, self).__init__(device_type='water_level', device_name=device_name)
         self.__gpio = gpio
         GPIO.setup(self.__gpio, GPIO.IN)
+        self.sampler = Sampler('water_level_' + device_name, self.is_full, interval, sampler_max_age, self.changed)
+
+        self.__listeners = []
+        self.__lock = threading.Lock()
+        self.__debounce_timer = None
+        self.__last_state = self.is_full()
+        try:
+            GPIO.add_event_detect(self.__gpio, GPIO.BOTH, callback=self.__on_edge)
+        except RuntimeError as e:
+            # Some kernels can't do edge detection, the fill valve watchdog still polls the pin
+            app.logger.warn('No edge detection on %s water level, only polling it: %s' % (device_name, e))
 
     def is_full(self):
         return GPIO.input(self.__gpio)
 
-    def get_body(self):
+    def add_listener(self, listener):
+        '''
+        Call listener(is_full) whenever the float switch settles in a new state
+        '''
+        self.__listeners.append(listener)
+
+    def __on_edge(self, channel):
+        # The float switch bounces, restart the timer on every edge and only
+        # read the level once it has been quiet for a while
+        with self.__lock:
+            if self.__debounce_timer is not None:
+                self.__debounce_timer.cancel()
+            self.__debounce_timer = hardware.clock.timer(water_level_debounce, self.__settled)
+            self.__debounce_timer.start()
+
+    def __settled(self):
+        state = self.sampler.sample().value
+        with self.__lock:
+            if state == self.__last_state:
+                return
+            self.__last_state = state
+
+        for listener in self.__listeners:
+            try:
+                listener(state)
+            except Exception:
+                app.logger.exception('Water level listener failed')
+
+    def get_body(self, fresh=False):
         '''
         Get the body we send out for response/notify
         '''
+        return self.format_body(self.sampler.get(fresh).value)
+
+    def status_body(self):
+        sample = self.sampler.latest()
+        return self.format_body(sample.value if sample is not None else None)
+
+    def format_body(self, state):
         message = {
-            'state': self.is_full(),
+            'state': state,
         }
         body = json.dumps(message).encode()
         return body
 
-# Prepare scheduler
-scheduler = BackgroundScheduler(daemon=True)
-scheduler.start()
+# Prepare scheduler, it is started by main()
+scheduler = hardware.make_scheduler({'default': scheduler_threads, SAFETY: scheduler_safety_threads})
+
+def on_deadline_miss(job_id, lateness, safety):
+    app.logger.error('Job %s started %.1f seconds late' % (job_id, lateness))
+    if safety:
+        fail_safe('Job %s started %.1f seconds late' % (job_id, lateness))
+
+# Jobs are added through here so we know when they start late
+job_monitor = JobMonitor(scheduler, on_deadline_miss, logger=app.logger)
 
-auto_fill_locked_out = False
+# Metrics for /metrics
+onewire_reads = metrics.counter('tank_onewire_reads_total', 'One-wire temperature conversions', ('result',))
+pipeline_tick = metrics.histogram('tank_pipeline_tick_seconds', 'Time taken to acquire a reading and hand it to every sink', ('tank',))
 
 default_max_fill_time = 60 * 2 # 2 minutes
 
-current_max_fill_time = default_max_fill_time
+# What is using each pin, bus address and sensor, so a config mistake can't
+# have two devices driving the same hardware
+claims = {}
+
+def claim(resource, device):
+    owner = claims.setdefault(resource, device)
+    if owner != device:
+        raise ValueError('%s and %s are both configured on %s' % (owner, device, resource))
+
+def tank_path(path, name):
+    '''
+    A per-tank version of a file path, history.dat becomes history_<name>.dat
+    '''
+    root, ext = os.path.splitext(path)
+    return root + '_' + name + ext
+
+class Tank:
+    '''
+    Everything for one tank: its sensors, valves and light, its fill state,
+    and the jobs and pipeline that look after it.
+
+    Devices are built from the tank's [tank:<name>] section and job ids are
+    prefixed with its name. The first tank keeps the original valve names,
+    history file and ThingSpeak channel so existing SmartThings devices and
+    data carry on working.
+    '''
+    def __init__(self, name, first=False):
+        self.name = name
+        section = 'tank:' + name
+
+        # Fill state, restored from the last run
+        self.__state = {
+            'auto_fill_locked_out': False,
+            'current_max_fill_time': default_max_fill_time,
+            'water_change': None,
+        }
+        self.__state.update(state_store.get('tank/' + name, {}))
+        # Held while deciding whether to close the fill valve, the float switch
+        # edge and the watchdog job can both get here at the same time
+        self.fill_lock = threading.Lock()
+
+        # Our sensors
+        serial = config.get(section, 'temperature_serial', fallback=tank_defaults['temperature_serial'])
+        ph_bus = config.getint(section, 'ph_bus', fallback=AtlasI2C.default_bus)
+        ph_address = config.getint(section, 'ph_address', fallback=tank_defaults['ph_address'])
+        water_level_gpio = config.getint(section, 'water_level_gpio', fallback=tank_defaults['water_level_gpio'])
+        claim(('onewire', serial), name + ' temperature sensor')
+        claim(('i2c', ph_bus, ph_address), name + ' pH sensor')
+        claim(('gpio', water_level_gpio), name + ' water level sensor')
+
+        self.temp_sensor = TemperatureSensor(name, serial,
+            config.getfloat(section, 'temperature_interval', fallback=temperature_interval))
+        self.ph_sensor = PHSensor(name, self.temp_sensor, ph_address, ph_bus,
+            config.getfloat(section, 'ph_interval', fallback=ph_interval),
+            config.getboolean(section, 'ph_stream', fallback=ph_stream))
+        self.water_level_sensor = WaterLevelSensor(name, water_level_gpio,
+            config.getfloat(section, 'water_level_interval', fallback=water_level_interval))
+        self.water_level_sensor.add_listener(self.on_water_level_change)
+
+        # Our valves
+        drain_gpio = config.getint(section, 'drain_gpio', fallback=tank_defaults['drain_gpio'])
+        fill_gpio = config.getint(section, 'fill_gpio', fallback=tank_defaults['fill_gpio'])
+        claim(('gpio', drain_gpio), name + ' drain valve')
+        claim(('gpio', fill_gpio), name + ' fill valve')
+        valve_prefix = config.get(section, 'valve_prefix', fallback='' if first else name + '_')
+        self.valves = {
+            'drain': Valve(valve_prefix + 'drain', drain_gpio,
+                # On open, we start a 5 minute timer
+                # If the valve is still open at the end of the timer, close it for safety
+                open_action = lambda: job_monitor.add_job(self.close_drain_after_timeout, 'interval', self.job_id('close_drain_after_timeout'),
+                    deadline=safety_deadline, safety=True, seconds=300),
+                close_action = lambda: job_monitor.remove_job(self.job_id('close_drain_after_timeout')),
+                on_preempt = self.on_valve_preempted
+            ),
+            'fill': Valve(valve_prefix + 'fill', fill_gpio,
+                # On open, we first check that the tank isn't already full
+                # The float switch closes the valve as soon as the tank is full, we also
+                # check every few seconds in case an edge was missed
+                # close_fill_when_full will also close the fill valve if left open for too long.
+                open_precheck= lambda: not self.water_level_sensor.is_full(),
+                open_action = lambda: job_monitor.add_job(self.close_fill_when_full, 'interval', self.job_id('close_fill_when_full'),
+                    deadline=safety_deadline, safety=True, seconds=water_level_watchdog_interval),
+                close_action = self.on_fill_close,
+                on_preempt = self.on_valve_preempted
+            ),
+        }
+
+        # Our light
+        day_light_gpio = config.getint(section, 'day_light_gpio', fallback=tank_defaults['day_light_gpio'])
+        night_light_gpio = config.getint(section, 'night_light_gpio', fallback=tank_defaults['night_light_gpio'])
+        claim(('gpio', day_light_gpio), name + ' day light')
+        claim(('gpio', night_light_gpio), name + ' night light')
+        self.light = Light(name, day_light_gpio, night_light_gpio)
+
+        # Each tick takes every sampler's snapshot once and the same reading goes to every sink.
+        # The samplers' own jobs do the reading, the hardware is only touched here if a snapshot
+        # is older than max_age
+        self.pipeline = Pipeline(app.logger)
+        self.pipeline.add_source('temperature', lambda: self.temp_sensor.sampler.get().value)
+        self.pipeline.add_source('pH', lambda: self.ph_sensor.sampler.get().value)
+        self.pipeline.add_source('water_level', lambda: self.water_level_sensor.sampler.get().value)
+
+        self.thingspeak_uploader = None
+        api_key = config.get(section, 'thingspeak_api_key', fallback=thingspeak_api_key if first else '').strip()
+        if api_key:
+            self.thingspeak_uploader = ThingSpeakUploader(api_key,
+                config.get(section, 'thingspeak_queue_path', fallback=thingspeak_queue_path if first else tank_path(thingspeak_queue_path, name)),
+                channel_id=config.get(section, 'thingspeak_channel_id', fallback=thingspeak_channel_id if first else '').strip() or None,
+                base_url=thingspeak_url,
+                batch_size=thingspeak_batch_size,
+                logger=app.logger)
+            self.thingspeak_uploader.start()
+            self.pipeline.add_sink(self.log_to_thingspeak)
+        self.pipeline.add_sink(self.notify_smartthings)
+        self.pipeline.add_sink(self.log_reading)
+
+        # Local sensor history, so we still have it when the network is down
+        self.history = HistoryStore(
+            config.get(section, 'history_path', fallback=history_path if first else tank_path(history_path, name)),
+            history_fields, int(history_retention_days * 24 * 60))
+        self.pipeline.add_sink(lambda reading: self.history.append(reading.timestamp, [reading.get(f) for f in history_fields]))
+
+        # Watch for drift, failing heaters and stuck sensors
+        # The detector needs numpy, so it is only built by init_anomalies()
+        self.anomaly_rules = anomaly_rules.get(name, [])
+        check_rules(history_fields, self.anomaly_rules)
+        self.anomalies = None
+        self.__anomalies_lock = threading.Lock()
+        if self.anomaly_rules:
+            self.pipeline.add_sink(self.check_anomalies)
+
+    def __set_state(self, key, value):
+        self.__state[key] = value
+        state_store.set('tank/' + self.name, dict(self.__state))
+
+    @property
+    def auto_fill_locked_out(self):
+        return self.__state['auto_fill_locked_out']
+
+    @auto_fill_locked_out.setter
+    def auto_fill_locked_out(self, value):
+        self.__set_state('auto_fill_locked_out', value)
+
+    @property
+    def current_max_fill_time(self):
+        return self.__state['current_max_fill_time']
+
+    @current_max_fill_time.setter
+    def current_max_fill_time(self, value):
+        self.__set_state('current_max_fill_time', value)
+
+    @property
+    def water_change(self):
+        '''
+        The water change in progress, if any: its stage (drain or fill),
+        when it started and how long it drains for
+        '''
+        return self.__state['water_change']
+
+    @water_change.setter
+    def water_change(self, value):
+        self.__set_state('water_change', value)
 
-# Our sensors
-temp_sensor = TemperatureSensor('tank')
-ph_sensor = PHSensor('tank', temp_sensor)
-water_level_sensor = WaterLevelSensor('tank', 5)
+    def job_id(self, job):
+        return self.name + '_' + job
 
-@scheduler.scheduled_job('interval', id='top_off', minutes=5)
-def top_off():
-    global current_max_fill_time
+    def devices(self):
+        return [self.light, self.temp_sensor, self.ph_sensor, self.water_level_sensor] + list(self.valves.values())
 
-    if not water_level_sensor.is_full():
-        # Don't run if we've had a timeout error
-        if auto_fill_locked_out:
-            app.logger.warn("Auto-fill locked out, not filling")
+    def bus_samplers(self):
+        '''
+        The samplers that read a shared bus, as (bus, sampler) pairs
+        '''
+        return [
+            ('onewire', self.temp_sensor.sampler),
+            (('i2c', self.ph_sensor.bus), self.ph_sensor.sampler),
+        ]
+
+    def schedule(self, top_off_offset=0):
+        for sensor in (self.temp_sensor, self.ph_sensor, self.water_level_sensor):
+            sensor.sampler.schedule(job_monitor)
+        job_monitor.add_job(self.top_off, 'interval', self.job_id('top_off'), deadline=safety_deadline, safety=True,
+            minutes=5, start_date=hardware.clock.now() + timedelta(minutes=5, seconds=top_off_offset))
+
+    def top_off(self):
+        if not self.water_level_sensor.is_full():
+            # Don't run if we've had a timeout error
+            if self.auto_fill_locked_out:
+                app.logger.warn("Auto-fill locked out on " + self.name + ", not filling")
+                return
+
+            # Only one valve can be open at a time, don't interrupt another tank
+            if not any(valve.is_open() for valve in valves.values()):
+                app.logger.info("Topping off " + self.name)
+                self.current_max_fill_time = 15 # 15 seconds should be plenty for a top off
+                fill_valve = self.valves['fill']
+                fill_valve.open()
+                fill_valve.notify()
+
+    def close_drain_after_timeout(self):
+        app.logger.warn('Closing ' + self.name + ' drain after timeout')
+        drain_valve = self.valves['drain']
+        event_journal.record('drain_timeout', 'tank/' + self.name, { 'seconds': round(drain_valve.open_duration(), 3) })
+        drain_valve.close()
+        drain_valve.notify()
+        alert_dispatcher.submit(self.name + '/drain_timeout', 'Drain timeout', 'Closing ' + self.name + ' drain after timeout')
+
+    def close_fill_when_full(self):
+        with self.fill_lock:
+            self.check_fill()
+
+    def check_fill(self):
+        #app.logger.info("Checking if tank is full")
+        fill_valve = self.valves['fill']
+        if not fill_valve.is_open():
             return
 
-        fill_valve = valves['fill']
-        drain_valve = valves['drain']
-        if not fill_valve.is_open() and not drain_valve.is_open():
-            app.logger.info("Topping off tank")
-            current_max_fill_time = 15 # 15 seconds should be plenty for a top off
-            fill_valve.open()
+        self.water_level_sensor.notify()
+        if self.water_level_sensor.is_full():
+            app.logger.info(self.name + " is full, closing fill valve")
+            event_journal.record('fill_complete', 'tank/' + self.name, { 'seconds': round(fill_valve.open_duration(), 3) })
+            self.auto_fill_locked_out = False
+            fill_valve.close()
             fill_valve.notify()
 
-def close_drain_after_timeout():
-    app.logger.warn('Closing drain after timeout')
-    drain_valve = valves['drain']
-    drain_valve.close()
-    drain_valve.notify()
-    mail('Drain timeout', 'Closing drain after timeout')
-
-def close_fill_when_full():
-    global auto_fill_locked_out
-    global current_max_fill_time
-
-    #app.logger.info("Checking if tank is full")
-    fill_valve = valves['fill']
-    water_level_sensor.notify()
-    if water_level_sensor.is_full():
-        app.logger.info("Tank is full, closing fill valve")
-        auto_fill_locked_out = False
-        fill_valve.close()
-        fill_valve.notify()
+            # Restore this to the default
+            self.current_max_fill_time = default_max_fill_time
+        elif fill_valve.open_duration() > self.current_max_fill_time:
+            app.logger.warn(self.name + " fill valve open for too long!")
+            # This also locks out auto-fill until the tank is next seen full
+            event_journal.record('fill_timeout', 'tank/' + self.name, { 'seconds': round(fill_valve.open_duration(), 3) })
+            self.auto_fill_locked_out = True
+            fill_valve.close()
+            fill_valve.notify()
+            alert_dispatcher.submit(self.name + '/fill_timeout', 'Fill timeout', 'Closing ' + self.name + ' fill after timeout')
 
-        # Restore this to the default
-        current_max_fill_time = default_max_fill_time
-    elif fill_valve.open_duration() > current_max_fill_time:
-        app.logger.warn("Fill valve open for too long!")
-        auto_fill_locked_out = True
-        fill_valve.close()
+    # Stop draining the tank
+    def water_change_drain_complete(self):
+        job_monitor.remove_job(self.job_id('water_change_drain_complete'))
+
+        app.logger.info("Water drain complete on " + self.name + ", starting fill...")
+
+        drain_valve = self.valves['drain']
+        drain_valve.close()
+        drain_valve.notify()
+
+        self.start_water_change_fill()
+
+    def start_water_change_fill(self):
+        if self.water_change is not None:
+            self.water_change = dict(self.water_change, stage='fill')
+
+        fill_valve = self.valves['fill']
+        fill_valve.open() # Should auto shut-off when full
         fill_valve.notify()
-        mail('Fill timeout', 'Closing fill after timeout')
-
-# Stop draining the tank
-def water_change_drain_complete():
-    scheduler.remove_job('water_change_drain_complete')
-
-    app.logger.info("Water drain complete, starting fill...")
-
-    # TODO: If the user closes the drain early, close() throws an exception trying to run the close action
-    drain_valve = valves['drain']
-    drain_valve.close()
-    drain_valve.notify()
-
-    fill_valve = valves['fill']
-    fill_valve.open() # Should auto shut-off when full
-    fill_valve.notify()
-
-def on_fill_close():
-    global current_max_fill_time
-    current_max_fill_time = default_max_fill_time
-    scheduler.remove_job('close_fill_when_full')
-
-# Our valves
-valves = {
-    'drain': Valve('drain', 17,
-        # On open, we start a 5 minute timer
-        # If the valve is still open at the end of the timer, close it for safety
-        open_action = lambda: scheduler.add_job(close_drain_after_timeout, 'interval', seconds=300, id='close_drain_after_timeout'),
-        close_action = lambda: scheduler.remove_job('close_drain_after_timeout')
-    ),
-    'fill': Valve('fill', 27,
-        # On open, we first check that the tank isn't already full
-        # We also check every second to make sure the tank hasn't filled up
-        # close_fill_when_full will also close the fill valve if left open for too long.
-        open_precheck= lambda: not water_level_sensor.is_full(),
-        open_action = lambda: scheduler.add_job(close_fill_when_full, 'interval', seconds=3, id='close_fill_when_full'),
-        close_action = on_fill_close
-    ),
-}
+        if not fill_valve.is_open():
+            # Already full, there is nothing left to do
+            self.water_change = None
 
-# Our lights
-lights = {
-    'tank': Light('tank')
-}
+    def resume_water_change(self):
+        '''
+        Pick up a water change that was running when we stopped. The valves
+        were closed when we started, so the drain only runs for whatever is
+        left of its time since the change started, then the tank is filled as
+        usual. If we were gone too long the drain is skipped and the tank is
+        just filled back up.
+        '''
+        water_change = self.water_change
+        if water_change is None:
+            return
 
-def log_to_thingspeak():
-    tempC = temp_sensor.readC()
-    tempF = temp_sensor.celcius_to_fahrenheit(tempC)
-    pH = ph_sensor.read(tempC)
-    try:
-        f = urllib.request.urlopen(thingspeak_base_url + "&field1=%s&field2=%s" % (str(tempF), str(pH)), timeout=15)
-        f.close()
-    except Exception:
-        # For some reason the data was not accepted
-        # ThingSpeek gives a lot of 500 errors
-        pass
-
-@scheduler.scheduled_job('cron', id='log_to_cloud', minute='*')
+        if self.auto_fill_locked_out:
+            app.logger.warn("Auto-fill locked out on " + self.name + ", abandoning interrupted water change")
+            self.water_change = None
+            alert_dispatcher.submit(self.name + '/water_change_aborted', 'Water change aborted',
+                'Auto-fill on ' + self.name + ' is locked out, not finishing the interrupted water change')
+            return
+
+        elapsed = hardware.clock.time() - water_change['started']
+        remaining = water_change['drain_time'] - elapsed
+        if water_change['stage'] == 'drain' and remaining > 0 and elapsed < water_change_resume_window:
+            app.logger.info("Resuming water change on %s, draining for %d more seconds" % (self.name, remaining))
+            job_monitor.add_job(self.water_change_drain_complete, 'interval', self.job_id('water_change_drain_complete'),
+                deadline=safety_deadline, safety=True, seconds=remaining)
+            drain_valve = self.valves['drain']
+            drain_valve.open()
+            drain_valve.notify()
+            return
+
+        app.logger.info("Finishing interrupted water change on " + self.name + ", starting fill...")
+        self.start_water_change_fill()
+
+    def on_fill_close(self):
+        self.current_max_fill_time = default_max_fill_time
+        self.water_change = None
+        job_monitor.remove_job(self.job_id('close_fill_when_full'))
+
+    def other_tank_valve_open(self):
+        own = list(self.valves.values())
+        return any(valve.is_open() for valve in valves.values() if valve not in own)
+
+    def on_valve_preempted(self, valve, opening):
+        '''
+        One of our valves is being closed so another one can open. That ends
+        any water change we were in the middle of, so make sure someone hears about it.
+        '''
+        if self.water_change is None:
+            return
+        stage = self.water_change.get('stage')
+        app.logger.warn('Water change on ' + self.name + ' aborted, ' + valve.device_name + ' closed to open ' + opening.device_name)
+        event_journal.record('water_change_aborted', 'tank/' + self.name, { 'stage': stage, 'opened': opening.device_path })
+        self.stop()
+        alert_dispatcher.submit(self.name + '/water_change_aborted', 'Water change aborted',
+            'The ' + str(stage) + ' stage of the water change on ' + self.name + ' was cut short when ' + valve.device_name +
+            ' was closed to open ' + opening.device_name + ', check the water level')
+
+    def on_water_level_change(self, full):
+        event_journal.record('float_switch', 'tank/' + self.name, { 'full': bool(full) })
+        if full and self.valves['fill'].is_open():
+            self.close_fill_when_full()
+
+    def change_water(self, time : int = None):
+        if not self.water_level_sensor.is_full():
+            event_journal.record('water_change_refused', 'tank/' + self.name, { 'reason': 'not full' })
+            return "Tank not full, politely refusing", 406
+
+        if self.auto_fill_locked_out:
+            app.logger.info("Auto-fill is locked due to error, refusing water change")
+            event_journal.record('water_change_refused', 'tank/' + self.name, { 'reason': 'auto-fill locked out' })
+            return "Auto-fill is locked due to error, refusing water change", 500
+
+        # Opening our drain would close the other tank's valve, and cut short whatever it was doing
+        if self.other_tank_valve_open():
+            app.logger.info("Another tank's valve is open, refusing water change on " + self.name)
+            event_journal.record('water_change_refused', 'tank/' + self.name, { 'reason': 'another tank busy' })
+            return "Another tank's valve is open, refusing water change", 409
+
+        if time is None:
+            time = 60 * 2 # 2 minutes
+        # From HTTP or replay.py this is still a string
+        time = int(time)
+
+        app.logger.info("Starting " + str(time) + " second water change on " + self.name)
+        event_journal.record('water_change', 'tank/' + self.name, { 'drain_time': time })
+
+        # How long (at most) we want to run the fill up
+        self.current_max_fill_time = 60 * 18 # 18 minutes
+        self.water_change = { 'stage': 'drain', 'started': hardware.clock.time(), 'drain_time': time }
+
+        job_monitor.add_job(self.water_change_drain_complete, 'interval', self.job_id('water_change_drain_complete'),
+            deadline=safety_deadline, safety=True, seconds=time)
+        drain_valve = self.valves['drain']
+        drain_valve.open()
+        drain_valve.notify()
+        return "OK"
+
+    def log_to_thingspeak(self, reading):
+        # Only queues the point, the uploader sends it in the background
+        tempC = reading.get('temperature')
+        tempF = self.temp_sensor.celcius_to_fahrenheit(tempC) if tempC is not None else None
+        self.thingspeak_uploader.submit(reading.timestamp, {
+            'field1': tempF,
+            'field2': reading.get('pH'),
+        })
+
+    def notify_smartthings(self, reading):
+        self.water_level_sensor.notify(self.water_level_sensor.format_body(reading.get('water_level')))
+        self.temp_sensor.notify(self.temp_sensor.format_body(reading.get('temperature')))
+        self.ph_sensor.notify(self.ph_sensor.format_body(reading.get('pH')))
+
+    def stop(self):
+        '''
+        Close our valves and abandon a water change, so nothing opens them again
+        '''
+        if self.water_change is not None:
+            try:
+                job_monitor.remove_job(self.job_id('water_change_drain_complete'))
+            except JobLookupError:
+                pass
+            self.water_change = None
+
+        for valve in self.valves.values():
+            if valve.is_open():
+                valve.close()
+                valve.notify()
+
+    def init_anomalies(self):
+        with self.__anomalies_lock:
+            if self.anomalies is None:
+                self.anomalies = AnomalyDetector(history_fields, self.anomaly_rules, anomaly_capacity)
+            return self.anomalies
+
+    def check_anomalies(self, reading):
+        self.init_anomalies()
+        self.anomalies.add(reading.timestamp, [reading.get(f) for f in history_fields])
+        alerts, cleared = self.anomalies.evaluate()
+        for alert in alerts:
+            app.logger.warn('Anomaly %s on %s: %s' % (alert.rule.name, self.name, alert))
+            alert_dispatcher.submit(self.name + '/anomaly/' + alert.rule.name, 'Anomaly on ' + self.name + ': ' + alert.rule.name, str(alert))
+        for rule in cleared:
+            app.logger.info('Anomaly %s on %s cleared' % (rule.name, self.name))
+
+    def log_reading(self, reading):
+        app.logger.info('%s temperature: %s C, pH: %s, water level: %s' % (self.name,
+            reading.get('temperature'), reading.get('pH'), reading.get('water_level')))
+
+history_fields = ['temperature', 'pH', 'water_level']
+
+# Our tanks
+tanks = {}
+for index, name in enumerate(tank_names):
+    tanks[name] = Tank(name, first=index == 0)
+startup.mark('devices')
+
+# Every valve and light by device name, for the HTTP resources
+valves = {valve.device_name: valve for tank in tanks.values() for valve in tank.valves.values()}
+lights = {tank.light.device_name: tank.light for tank in tanks.values()}
+
+# The tanks share the one-wire and I2C buses, stagger their reads so they take
+# turns on each bus, and their top offs so they don't all want a valve at once
+bus_samplers = {}
+for tank in tanks.values():
+    for bus, sampler in tank.bus_samplers():
+        bus_samplers.setdefault(bus, []).append(sampler)
+for samplers in bus_samplers.values():
+    stagger(samplers)
+for index, tank in enumerate(tanks.values()):
+    tank.schedule(top_off_offset=index * 300.0 / len(tanks))
+    tank.resume_water_change()
+startup.mark('jobs')
+
+def init_hardware():
+    '''
+    Open every sensor and get the anomaly detectors ready, all at once.
+    Anything that isn't ready by the time it is needed is done on first use.
+    '''
+    started = time.monotonic()
+    tasks = []
+    for tank in tanks.values():
+        tasks.extend([tank.temp_sensor.init, tank.ph_sensor.init])
+        if tank.anomaly_rules:
+            tasks.append(tank.init_anomalies)
+
+    with ThreadPoolExecutor(len(tasks), thread_name_prefix='init') as pool:
+        futures = [pool.submit(task) for task in tasks]
+    for future in futures:
+        try:
+            future.result()
+        except Exception:
+            app.logger.exception('Failed to initialize hardware, trying again on first use')
+    startup.record('hardware', time.monotonic() - started)
+
+def fail_safe(reason):
+    '''
+    Close every valve on every tank
+    '''
+    app.logger.error('Fail-safe: ' + reason + ', closing all valves')
+    for tank in tanks.values():
+        tank.stop()
+    alert_dispatcher.submit('fail_safe', 'Fail-safe triggered', reason + ', closed all valves')
+
+def change_water(time : int = None, tank=tank_names[0]):
+    return tanks[tank].change_water(time)
+
+@job_monitor.scheduled_job('cron', 'log_to_cloud', deadline=telemetry_deadline, minute='*')
 def log_to_cloud():
-    # Notify ThingSpeak
-    if thingspeak_base_url:
-        log_to_thingspeak()
+    for tank in tanks.values():
+        with pipeline_tick.time(tank=tank.name):
+            tank.pipeline.tick()
+
+hardware_limiter = ResourceLimiter(hardware_limits, hardware_wait)
+
+# Devices found on the I2C buses
+i2c_registry = DeviceRegistry(i2c_registry_path, i2c_buses, app.logger)
+
+def discover_i2c_devices():
+    for info in i2c_registry.discover():
+        app.logger.info('I2C bus %d address %d: %s %s' % (info.bus, info.address, info.type or 'unknown', info.firmware or ''))
+
+def fresh_requested():
+    '''
+    Check if the client asked us to bypass the sampler with ?fresh=1
+    '''
+    return request.args.get('fresh', '').lower() in ('1', 'true', 'yes')
 
-    # Notify SmartThings
-    water_level_sensor.notify()
-    temp_sensor.notify()
-    ph_sensor.notify()
+def sensor_response(sensor, resource):
+    '''
+    Respond for a sensor, waiting our turn on its hardware if we have to read it
+    '''
+    try:
+        with hardware_limiter.hold(resource):
+            return sensor.get_response(fresh=fresh_requested())
+    except Busy:
+        return "Sensor busy, try again later", 503
 
 class Temperature(Resource):
     def get(self, name):
-        if(name == "tank"):
-            return temp_sensor.get_response()
+        tank = tanks.get(name)
+        if tank is not None:
+            return sensor_response(tank.temp_sensor, 'onewire')
 
         return "Temperature sensor not found", 404
 
 class PH(Resource):
     def get(self, name):
-        if(name == "tank"):
-            return ph_sensor.get_response()
+        tank = tanks.get(name)
+        if tank is not None:
+            return sensor_response(tank.ph_sensor, 'i2c')
 
         return "pH sensor not found", 404
 
 class WaterLevel(Resource):
     def get(self, name):
-        if(name == "tank"):
-            return water_level_sensor.get_response()
+        tank = tanks.get(name)
+        if tank is not None:
+            return sensor_response(tank.water_level_sensor, 'gpio')
 
-        return "pH sensor not found", 404
+        return "Water level sensor not found", 404
+
+class History(Resource):
+    # URL names to history fields
+    fields = {
+        'temperature': 'temperature',
+        'ph': 'pH',
+        'water_level': 'water_level',
+    }
+
+    def get(self, name):
+        field = self.fields.get(name)
+        if field is None:
+            return "Sensor not found", 404
+
+        # Parse arguments
+        parser = reqparse.RequestParser()
+        parser.add_argument('from', type=float, location='args')
+        parser.add_argument('to', type=float, location='args')
+        parser.add_argument('step', type=float, location='args')
+        parser.add_argument('tank', location='args')
+        args = parser.parse_args()
+
+        tank = tanks.get(args.get('tank') or tank_names[0])
+        if tank is None:
+            return "Tank not found", 404
+
+        end = args.get('to')
+        if end is None:
+            end = hardware.clock.time()
+        start = args.get('from')
+        if start is None:
+            start = end - 24 * 60 * 60 # 1 day
+        step = args.get('step')
+        if step is not None and step <= 0:
+            return "Invalid step", 400
+
+        points = [[t, round(v, 3)] for t, v in tank.history.query(field, start, end, step)]
+        return { 'sensor': name, 'tank': tank.name, 'from': start, 'to': end, 'step': step, 'points': points }
 
 class ValveHTTP(Resource):
     def get(self, name):
@@ -496,6 +1306,7 @@ class Subscription(Resource):
         new_smartthings_notify_url = 'http://' + name.strip()
         if new_smartthings_notify_url != smartthings_notify_url:
             smartthings_notify_url = new_smartthings_notify_url
+            notifier.set_url(smartthings_notify_url)
             # Update our config file
             if not config.has_section('smartthings'):
                 config.add_section('smartthings')
@@ -529,55 +1340,173 @@ class LightHTTP(Resource):
         light.set_state(state)
         return light.get_response()
 
-def change_water(time : int = None):
-    global current_max_fill_time
-
-    if not water_level_sensor.is_full:
-        return "Tank not full, politely refusing", 406
-
-    if auto_fill_locked_out:
-        app.logger.info("Auto-fill is locked due to error, refusing water change")
-        return "Auto-fill is locked due to error, refusing water change", 500
-
-    if time is None:
-        time = 60 * 2 # 2 minutes
-
-    app.logger.info("Starting " + str(time) + " second water change")
-
-    # How long (at most) we want to run the fill up
-    current_max_fill_time = 60 * 18 # 18 minutes
-
-    scheduler.add_job(water_change_drain_complete, 'interval', seconds=time, id='water_change_drain_complete')
-    drain_valve = valves['drain']
-    drain_valve.open()
-    drain_valve.notify()
-    return "OK"
-
 class Action(Resource):
     def post(self, name):
         if name == 'change_water':
             parser = reqparse.RequestParser()
             parser.add_argument('time')
+            parser.add_argument('tank')
             args = parser.parse_args()
             time = args.get('time')
 
-            return change_water(time)
+            tank = tanks.get(args.get('tank') or tank_names[0])
+            if tank is None:
+                return "Tank not found", 404
+
+            return tank.change_water(time)
 
         return "Action not found", 404
 
+class EventLog(Resource):
+    def get(self):
+        # Parse arguments
+        parser = reqparse.RequestParser()
+        parser.add_argument('type', location='args')
+        parser.add_argument('from', type=float, location='args')
+        parser.add_argument('to', type=float, location='args')
+        parser.add_argument('device', location='args')
+        args = parser.parse_args()
+
+        # type can list several, like ?type=valve_open,valve_close
+        types = None
+        if args.get('type'):
+            types = [t.strip() for t in args.get('type').split(',') if t.strip()]
+            unknown = [t for t in types if t not in EVENT_TYPES]
+            if unknown:
+                return "Unknown event type " + ', '.join(unknown), 400
+
+        events = event_journal.query(types, args.get('from'), args.get('to'), args.get('device'))
+
+        def generate():
+            # One event at a time, the log can be much bigger than we want to hold in memory
+            separator = '['
+            for timestamp, type, device, details in events:
+                yield separator + json.dumps({ 'time': timestamp, 'type': type, 'device': device, 'details': details })
+                separator = ','
+            yield '[]' if separator == '[' else ']'
+
+        return Response(generate(), mimetype='application/json')
+
+class StatusCache:
+    '''
+    Pre-encoded body with every device's state, rebuilt only when a device's version changes
+    '''
+    def __init__(self, devices):
+        self.__devices = devices
+        self.__versions = None
+        self.__body = None
+        self.__etag = None
+        self.__lock = threading.Lock()
+
+    def get(self):
+        versions = tuple(device.version for device in self.__devices)
+        with self.__lock:
+            if versions != self.__versions:
+                parts = []
+                for device in self.__devices:
+                    # Only the snapshots, so a sensor that has stopped answering can't hold up or break /status
+                    parts.append(json.dumps(device.device_path).encode() + b':' + (device.status_body() or b'null'))
+                self.__body = b'{' + b','.join(parts) + b'}'
+                self.__etag = hashlib.sha1(self.__body).hexdigest()[:16]
+                self.__versions = versions
+            return self.__body, self.__etag
+
+status_cache = StatusCache([device for tank in tanks.values() for device in tank.devices()])
+
+metrics.gauge('tank_valve_open_seconds', 'How long each valve has been open, 0 when closed', ('valve',),
+    callback=lambda: {(name,): valve.open_duration() for name, valve in valves.items()})
+metrics.gauge('tank_notify_queue_depth', 'SmartThings NOTIFYs waiting to be sent',
+    callback=lambda: {(): notifier.depth()})
+metrics.gauge('tank_alert_queue_depth', 'Alerts waiting to be sent',
+    callback=lambda: {(): alert_dispatcher.depth()})
+metrics.gauge('tank_thingspeak_queue_depth', 'Points waiting to be uploaded to ThingSpeak', ('tank',),
+    callback=lambda: {(name,): len(tank.thingspeak_uploader.queue) for name, tank in tanks.items() if tank.thingspeak_uploader is not None})
+
+class I2CDevices(Resource):
+    def get(self):
+        if request.args.get('rescan', '').lower() in ('1', 'true', 'yes'):
+            try:
+                with hardware_limiter.hold('i2c'):
+                    i2c_registry.discover(rescan=True)
+            except Busy:
+                return "I2C bus busy, try again later", 503
+
+        return [info._asdict() for info in i2c_registry.devices()]
+
+class Metrics(Resource):
+    def get(self):
+        resp = make_response(metrics.REGISTRY.render())
+        resp.headers['Content-Type'] = 'text/plain; version=0.0.4'
+        return resp
+
+class Status(Resource):
+    def get(self):
+        body, etag = status_cache.get()
+        if request.if_none_match.contains(etag):
+            resp = make_response('', 304)
+        else:
+            resp = make_response(body)
+            resp.headers['Content-Type'] = 'application/json'
+        resp.set_etag(etag)
+        return resp
+
+class Events(Resource):
+    def get(self):
+        subscriber = event_bus.subscribe()
+        if subscriber is None:
+            return "Too many event subscribers, try again later", 503
+        resp = Response(event_bus.stream(subscriber), mimetype='text/event-stream')
+        # The stream's own cleanup never runs if the client goes before it starts
+        resp.call_on_close(lambda: event_bus.unsubscribe(subscriber))
+        resp.headers['Cache-Control'] = 'no-cache'
+        return resp
+
 api.add_resource(LightHTTP, "/light/<string:name>")
 api.add_resource(Temperature, "/temperature/<string:name>")
 api.add_resource(PH, "/ph/<string:name>")
 api.add_resource(WaterLevel, "/water_level/<string:name>")
 api.add_resource(ValveHTTP, "/valve/<string:name>")
+api.add_resource(History, "/history/<string:name>")
+api.add_resource(Status, "/status")
+api.add_resource(Events, "/events")
+api.add_resource(EventLog, "/events/log")
+api.add_resource(Metrics, "/metrics")
+api.add_resource(I2CDevices, "/i2c_devices")
 api.add_resource(Subscription, "/subscribe/<string:name>")
 api.add_resource(Action, "/action/<string:name>")
 
-try:
-    # With the reloader enabled, apscheduler executes twice, one in each process
-    # We could probably fix this correctly, but just disabling the reloader for now
-    app.run(debug=True,host='0.0.0.0', use_reloader=False)
-finally:
-    print("GPIO Cleanup")
-    GPIO.cleanup()
+def main():
+    # systemd may stop us with SIGTERM, make sure that still runs the cleanup below
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # Only ever start the scheduler once, otherwise every job runs twice
+    if not scheduler.running:
+        scheduler.start()
+    # Watch for safety jobs that are running late
+    job_monitor.start()
+    startup.mark('scheduler')
+
+    # Open the sensors and check the cached I2C devices are still there in the background
+    threading.Thread(target=init_hardware, name='init', daemon=True).start()
+    threading.Thread(target=discover_i2c_devices, name='discovery', daemon=True).start()
+    for tank in tanks.values():
+        tank.ph_sensor.start_stream()
+
+    def ready():
+        startup.mark('server')
+        app.logger.info('Serving after %.2f seconds' % startup.elapsed())
+
+    try:
+        server.serve(app, server_host, server_port, server_threads, server_request_timeout, ready, server_queue)
+    finally:
+        job_monitor.stop()
+        scheduler.shutdown(wait=False)
+        state_store.close()
+        event_journal.close()
+        alert_dispatcher.close()
+        print("GPIO Cleanup")
+        GPIO.cleanup()
+
+if __name__ == '__main__':
+    main()
 
@@ -0,0 +1,219 @@
+import collections
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from datetime import datetime
+
+import metrics
+
+UPLOAD_SECONDS = metrics.histogram('tank_thingspeak_upload_seconds', 'Time taken by a ThingSpeak upload request', ('result',))
+
+
+class OutboundQueue:
+    '''
+    Points waiting to be uploaded, kept as JSON lines on disk so they survive outages and restarts.
+
+    New points are appended to the file. Uploaded points are only counted off
+    the front of it, in a small offset file next to it, and the file is
+    rewritten (atomically) once that consumed prefix is at least compact_after
+    lines and as long as what is left, so a backlog is written out a couple of
+    times at most. At most max_points are kept, oldest dropped first.
+    '''
+    def __init__(self, path, max_points, compact_after=1000):
+        self.path = path
+        self.offset_path = path + '.offset'
+        self.compact_after = compact_after
+        self.__points = collections.deque(maxlen=max_points)
+        # Lines at the start of the file that are already uploaded or dropped
+        self.__consumed = 0
+        self.__lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        try:
+            with open(path, 'r') as f:
+                consumed = self.__read_offset(os.fstat(f.fileno()).st_ino)
+                for line in itertools.islice(f, consumed, None):
+                    try:
+                        self.__points.append(json.loads(line))
+                    except ValueError:
+                        # Partial line from a crash mid-write
+                        pass
+        except IOError:
+            pass
+
+        self.__offset_file = None
+        self.__rewrite()
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__points)
+
+    def __read_offset(self, inode):
+        # The offset is only good for the file it was written for, the
+        # queue file gets a new inode every time it is rewritten
+        try:
+            with open(self.offset_path, 'r') as f:
+                saved_inode, consumed = (int(value) for value in f.read().split())
+        except (IOError, ValueError):
+            # Missing, or cut short by a crash, at worst some points are sent twice
+            return 0
+        return consumed if saved_inode == inode else 0
+
+    def __write_offset(self):
+        # Not synced, the page cache batches these up
+        if self.__offset_file is None:
+            self.__offset_file = open(self.offset_path, 'w')
+        self.__offset_file.seek(0)
+        self.__offset_file.write('%d %d\n' % (self.__inode, self.__consumed))
+        self.__offset_file.truncate()
+        self.__offset_file.flush()
+
+    def __rewrite(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for point in self.__points:
+                f.write(json.dumps(point) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.__file = open(self.path, 'a')
+        self.__inode = os.fstat(self.__file.fileno()).st_ino
+        self.__consumed = 0
+        self.__write_offset()
+
+    def append(self, point):
+        with self.__lock:
+            if len(self.__points) == self.__points.maxlen:
+                # The oldest point is about to be dropped
+                self.__consumed += 1
+            self.__points.append(point)
+            self.__file.write(json.dumps(point) + '\n')
+            self.__file.flush()
+
+    def peek(self, count):
+        with self.__lock:
+            return list(itertools.islice(self.__points, count))
+
+    def remove(self, count):
+        with self.__lock:
+            for i in range(min(count, len(self.__points))):
+                self.__points.popleft()
+                self.__consumed += 1
+            if self.__consumed >= max(self.compact_after, len(self.__points)):
+                self.__file.close()
+                self.__rewrite()
+            else:
+                self.__write_offset()
+
+class ThingSpeakUploader:
+    '''
+    Uploads points to ThingSpeak from a background thread.
+
+    Points are queued on disk and sent in batches with their original
+    timestamps, so an outage only delays them. With a channel_id the bulk
+    update JSON API is used, otherwise points go one at a time through the
+    regular update API. Server errors back off exponentially.
+    '''
+    def __init__(self, api_key, queue_path, channel_id=None, base_url='https://api.thingspeak.com',
+                 batch_size=100, min_interval=15, max_backoff=600, max_points=50000, timeout=15, logger=None):
+        self.api_key = api_key
+        self.channel_id = channel_id
+        self.base_url = base_url.rstrip('/')
+        self.batch_size = batch_size if channel_id else 1
+        self.min_interval = min_interval
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.queue = OutboundQueue(queue_path, max_points)
+        self.__logger = logger or logging.getLogger(__name__)
+        self.__wakeup = threading.Event()
+        self.__thread = None
+
+    def submit(self, timestamp, fields):
+        '''
+        Queue a point, fields maps ThingSpeak field names (field1, field2...) to values
+        '''
+        point = { 'created_at': timestamp }
+        point.update({k: v for k, v in fields.items() if v is not None})
+        self.queue.append(point)
+        self.__wakeup.set()
+
+    def start(self):
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run, name='thingspeak', daemon=True)
+            self.__thread.start()
+
+    def __run(self):
+        backoff = self.min_interval
+        while True:
+            self.__wakeup.wait()
+            self.__wakeup.clear()
+
+            while len(self.queue):
+                batch = self.queue.peek(self.batch_size)
+                started = time.monotonic()
+                try:
+                    accepted = self.__send(batch)
+                except Exception as e:
+                    UPLOAD_SECONDS.observe(time.monotonic() - started, result='error')
+                    # Network trouble or a server error, keep the points and try again later
+                    self.__logger.warning('ThingSpeak upload failed, retrying in %gs: %s' % (backoff, e))
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+                    continue
+
+                UPLOAD_SECONDS.observe(time.monotonic() - started, result='ok' if accepted else 'rejected')
+                if not accepted:
+                    self.__logger.error('ThingSpeak rejected %d points, dropping them' % len(batch))
+                self.queue.remove(len(batch))
+                backoff = self.min_interval
+
+                # ThingSpeak rate limits updates per channel
+                time.sleep(self.min_interval)
+
+    @staticmethod
+    def format_timestamp(timestamp):
+        return datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def __send(self, batch):
+        '''
+        Send a batch, returns False if ThingSpeak refused it outright.
+        Raises on errors that are worth retrying.
+        '''
+        updates = []
+        for point in batch:
+            update = dict(point)
+            update['created_at'] = self.format_timestamp(point['created_at'])
+            updates.append(update)
+
+        if self.channel_id:
+            url = '%s/channels/%s/bulk_update.json' % (self.base_url, self.channel_id)
+            body = json.dumps({ 'write_api_key': self.api_key, 'updates': updates }).encode()
+            req = urllib.request.Request(url, method='POST', data=body, headers={ 'Content-Type': 'application/json' })
+        else:
+            params = { 'api_key': self.api_key }
+            params.update(updates[0])
+            req = urllib.request.Request(self.base_url + '/update?' + urllib.parse.urlencode(params))
+
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as f:
+                response = f.read()
+        except urllib.error.HTTPError as e:
+            # Too many requests and server errors are temporary
+            if e.code == 429 or e.code >= 500:
+                raise
+            return False
+
+        # The update API answers 0 when it didn't take the point
+        if not self.channel_id and response.strip() == b'0':
+            raise IOError('update not accepted')
+        return True